@@ -0,0 +1,40 @@
+"""Throughput of archiving transitions with `sts.archive`."""
+import os
+import sys
+import time
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--rows', type='int', default=1000000)
+    parser.add_option('--systems', type='int', default=1000)
+    parser.add_option('--batch-size', type='int', default=1000)
+    parser.add_option('--format', default='ndjson')
+    options, args = parser.parse_args()
+
+    from utils import populate
+    from sts.archive import archive_transitions, open_archive
+
+    populate(options.rows, options.systems)
+
+    fd, path = tempfile.mkstemp(suffix='.gz')
+    os.close(fd)
+
+    out = open_archive(path)
+    start = time.time()
+    count = archive_transitions(out, format=options.format,
+        policy={'default': 0}, batch_size=options.batch_size)
+    elapsed = time.time() - start
+    out.close()
+
+    print('archived {0} transitions in {1:.2f} s ({2:.0f}/s), {3} bytes'
+        .format(count, elapsed, count / elapsed, os.path.getsize(path)))
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Per-block overhead of the transition context manager modes."""
+import os
+import sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--blocks', type='int', default=1000)
+    parser.add_option('--repeat', type='int', default=5)
+    options, args = parser.parse_args()
+
+    from django.db import connection
+    from utils import timeit
+    from sts.buffer import TransitionBuffer
+    from sts.contextmanagers import transition
+    from sts.models import System
+
+    system = System.get('bench-contextmanager')
+    buffer = TransitionBuffer(threaded=False)
+
+    modes = (
+        ('eager', {}),
+        ('deferred', {'deferred': True}),
+        ('buffered (flushed after the blocks)', {'buffer': buffer}),
+    )
+
+    for name, kwargs in modes:
+        def run():
+            for _ in range(options.blocks):
+                with transition(system, 'Done', event='Work', **kwargs):
+                    pass
+            buffer.flush()
+
+        # Count the queries of a single block
+        connection.use_debug_cursor = True
+        del connection.queries[:]
+        with transition(system, 'Done', event='Work', **kwargs):
+            pass
+        buffer.flush()
+        queries = len(connection.queries)
+        connection.use_debug_cursor = None
+
+        elapsed = timeit(run, options.repeat)
+
+        print('== {0}'.format(name))
+        print('   queries per block: {0}'.format(queries))
+        print('   best of {0}: {1:.3f} ms per block'.format(options.repeat,
+            elapsed / options.blocks))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Micro-benchmark of the natural duration formatters."""
+import os
+import sys
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--count', type='int', default=100000)
+    parser.add_option('--repeat', type='int', default=5)
+    options, args = parser.parse_args()
+
+    from utils import timeit
+    from sts.utils import format_duration, get_natural_duration
+
+    start_time = datetime(2013, 5, 1)
+
+    # Durations from milliseconds to a few days
+    durations = [(i * 7919) % 300000000 for i in range(options.count)]
+    end_times = [start_time + timedelta(milliseconds=duration)
+        for duration in durations]
+
+    for short in (False, True):
+        print('== {0} durations (short={1})'.format(options.count, short))
+
+        def timesince():
+            for end_time in end_times:
+                get_natural_duration(start_time, end_time, short)
+
+        def fast():
+            for end_time in end_times:
+                get_natural_duration(start_time, end_time, short, fast=True)
+
+        def stored():
+            for duration in durations:
+                format_duration(duration, short)
+
+        for name, func in (('get_natural_duration', timesince),
+                ('get_natural_duration(fast=True)', fast),
+                ('format_duration', stored)):
+            print('   {0}: best of {1}: {2:.2f} ms'.format(name,
+                options.repeat, timeit(func, options.repeat)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Query plans and timings for the per-system Transition access patterns.
+
+Run before and after applying `sts` migration 0010 to compare.
+"""
+import os
+import sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--rows', type='int', default=10000000)
+    parser.add_option('--systems', type='int', default=10000)
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--no-populate', action='store_false', dest='populate',
+        default=True, help='Reuse existing bench-* systems.')
+    options, args = parser.parse_args()
+
+    from utils import populate, report
+    from sts.models import System, State
+
+    if options.populate:
+        populate(options.rows, options.systems)
+
+    system = System.objects.filter(name__startswith='bench-')[0]
+    transitions = system.transitions
+
+    latest = transitions.order_by('-start_time')[:1]
+    report('latest transition', latest, lambda: list(latest), options.repeat)
+
+    head = transitions.order_by('start_time')[:100]
+    report('first 100 transitions', head, lambda: list(head), options.repeat)
+
+    tail = transitions.order_by('-start_time')[:100]
+    report('last 100 transitions', tail, lambda: list(tail), options.repeat)
+
+    open_ = transitions.filter(state=State.TRANSITION)
+    report('open transition', open_, lambda: open_.exists(), options.repeat)
+
+
+if __name__ == '__main__':
+    main()
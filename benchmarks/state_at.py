@@ -0,0 +1,40 @@
+"""Timings of the state-at-time queries over large histories."""
+import os
+import sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--rows', type='int', default=10000000)
+    parser.add_option('--systems', type='int', default=10000)
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--no-populate', action='store_false', dest='populate',
+        default=True, help='Reuse existing bench-* systems.')
+    options, args = parser.parse_args()
+
+    from utils import populate, report, timeit
+    from sts.models import System, State, Transition
+
+    if options.populate:
+        populate(options.rows, options.systems)
+
+    system = System.objects.filter(name__startswith='bench-')[0]
+    first = Transition.objects.order_by('start_time')[0].start_time
+    last = Transition.objects.order_by('-start_time')[0].start_time
+    middle = first + (last - first) / 2
+
+    print('== System.state_at (middle of history)')
+    print('   best of {0}: {1:.2f} ms'.format(options.repeat,
+        timeit(lambda: system.state_at(middle), options.repeat)))
+
+    state = State.objects.get(name='State 0')
+    systems = System.objects.in_state_at(state, middle)
+    report('System.objects.in_state_at (middle of history)', systems,
+        lambda: systems.count(), options.repeat)
+
+
+if __name__ == '__main__':
+    main()
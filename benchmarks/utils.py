@@ -0,0 +1,73 @@
+import time
+import random
+from datetime import timedelta
+from django.db import connections, transaction
+from django.utils import timezone
+
+
+def timeit(func, repeat=5):
+    "Returns the best wall time in milliseconds of `repeat` calls."
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = (time.time() - start) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def explain(queryset):
+    "Returns the query plan for a queryset as a list of lines."
+    connection = connections[queryset.db]
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+
+    if connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN'
+    elif connection.vendor == 'postgresql':
+        prefix = 'EXPLAIN ANALYZE'
+    else:
+        prefix = 'EXPLAIN'
+
+    cursor = connection.cursor()
+    cursor.execute('{0} {1}'.format(prefix, sql), params)
+    return [' '.join(str(c) for c in row) for row in cursor.fetchall()]
+
+
+def populate(rows, systems, batch_size=10000, states=10):
+    """Creates `systems` systems with `rows` transitions spread evenly across
+    them. Returns the list of systems.
+    """
+    from sts.models import System, State, Event, Transition
+
+    objs = [System.objects.create(name='bench-{0}'.format(i))
+        for i in range(systems)]
+    states = [State.get('State {0}'.format(i)) for i in range(states)]
+    event = Event.get('Bench')
+
+    start = timezone.now() - timedelta(seconds=rows)
+    batch = []
+
+    for i in range(rows):
+        batch.append(Transition(system=objs[i % systems], event=event,
+            state=random.choice(states), start_time=start + timedelta(seconds=i),
+            end_time=start + timedelta(seconds=i), duration=0))
+
+        if len(batch) == batch_size:
+            Transition.objects.bulk_create(batch)
+            transaction.commit_unless_managed()
+            batch = []
+
+    if batch:
+        Transition.objects.bulk_create(batch)
+        transaction.commit_unless_managed()
+
+    System.objects.rebuild_snapshots()
+    return objs
+
+
+def report(name, queryset, func, repeat=5):
+    print('== {0}'.format(name))
+    for line in explain(queryset):
+        print('   {0}'.format(line))
+    print('   best of {0}: {1:.2f} ms'.format(repeat, timeit(func, repeat)))
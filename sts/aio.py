@@ -0,0 +1,99 @@
+"""Runs blocking ORM work for asyncio code in a bounded thread pool.
+
+The `a`-prefixed methods (e.g. `System.atransition`, `State.aget`) return
+futures to be awaited from a coroutine. The pool holds `STS_ASYNC_WORKERS`
+threads (10 by default), which bounds the number of database connections
+used. Connections are kept open between calls, a call ends any transaction
+it left open and closes the connections if it raised. On Python 2 the
+`trollius` and `futures` packages provide asyncio and `concurrent.futures`.
+"""
+import threading
+from functools import partial
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, DatabaseError
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+
+# Default number of threads running ORM work
+DEFAULT_WORKERS = 10
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    "Returns the process-wide thread pool, created on first use."
+    global _executor
+
+    if asyncio is None or ThreadPoolExecutor is None:
+        raise ImproperlyConfigured('The async API requires asyncio and '
+            'concurrent.futures (trollius and futures on Python 2).')
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(getattr(settings,
+                'STS_ASYNC_WORKERS', DEFAULT_WORKERS))
+        return _executor
+
+
+def _end_transactions():
+    "Ends the transactions left open by a call without closing connections."
+    for connection in connections.all():
+        if connection.connection is None or connection.is_managed():
+            continue
+        try:
+            # Writes outside of managed transactions are already committed,
+            # this only ends the transaction implicitly opened by reads
+            connection._rollback()
+        except DatabaseError:
+            connection.close()
+
+
+def _call(func, args, kwargs):
+    try:
+        result = func(*args, **kwargs)
+    except:
+        # The connection may be broken or in a failed transaction
+        for connection in connections.all():
+            connection.close()
+        raise
+    _end_transactions()
+    return result
+
+
+def run(func, *args, **kwargs):
+    "Returns a future of `func(*args, **kwargs)` called in the thread pool."
+    executor = get_executor()
+    return asyncio.get_event_loop().run_in_executor(executor,
+        partial(_call, func, args, kwargs))
+
+
+def done(result):
+    "Returns a future already resolved to `result`."
+    if asyncio is None:
+        raise ImproperlyConfigured('The async API requires asyncio.')
+    future = asyncio.Future()
+    future.set_result(result)
+    return future
+
+
+def shutdown(wait=True):
+    "Shuts down the thread pool, a new one is created on the next call."
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait)
+            _executor = None
@@ -0,0 +1,180 @@
+"""Retention of old transitions.
+
+Transitions older than the retention period of their system's content type
+are written to an archive file and deleted in bounded batches. The policy is
+set by `STS_RETENTION`, a dict of retention days keyed by 'app_label.model'
+with a 'default' entry for every other system (including named systems):
+
+    STS_RETENTION = {
+        'auth.user': 30,
+        'default': 365,
+    }
+
+A content type without an entry (and no default) is kept indefinitely. The
+latest transition of each system and open transitions are never archived,
+so the current state of every system is preserved. Neither is the transition
+an open one was started from, which ending it is validated against.
+"""
+import csv
+import gzip
+import json
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import System, State, Transition
+
+FORMATS = ('ndjson', 'csv')
+
+FIELDS = ('id', 'system', 'state__name', 'event__name', 'message', 'failed',
+    'start_time', 'end_time', 'duration')
+
+
+def open_archive(path):
+    "Opens `path` for appending, gzip compressed if it ends with .gz."
+    if path.endswith('.gz'):
+        return gzip.open(path, 'ab')
+    return open(path, 'ab')
+
+
+def get_policy(policy=None):
+    """Returns a list of (queryset filter, exclude, days) tuples for the
+    policy, the default applies to content types without an entry. Raises
+    ValueError for a label that is not an installed content type.
+    """
+    if policy is None:
+        policy = getattr(settings, 'STS_RETENTION', {})
+
+    rules = []
+    listed = []
+
+    for label, days in policy.items():
+        if label == 'default':
+            continue
+        try:
+            app_label, model = label.split('.', 1)
+            content_type = ContentType.objects.get_by_natural_key(app_label,
+                model.lower())
+        except (ValueError, ContentType.DoesNotExist):
+            raise ValueError('Unknown content type "{0}" in the retention '
+                'policy, use "app_label.model".'.format(label))
+        listed.append(content_type.pk)
+        rules.append(({'system__content_type': content_type}, {}, days))
+
+    if policy.get('default') is not None:
+        excludes = listed and {'system__content_type__in': listed} or {}
+        rules.append(({}, excludes, policy['default']))
+
+    return rules
+
+
+class Writer(object):
+    "Writes transition rows as newline-delimited JSON or CSV."
+    def __init__(self, out, format='ndjson'):
+        if format not in FORMATS:
+            raise ValueError('Format must be one of {0}.'.format(
+                ', '.join(FORMATS)))
+        self.out = out
+        self.format = format
+        if format == 'csv':
+            self.writer = csv.writer(out)
+
+    def write(self, rows):
+        for row in rows:
+            if self.format == 'ndjson':
+                self.out.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+            else:
+                # The csv module does not support unicode
+                self.writer.writerow([value.encode('utf-8')
+                    if isinstance(value, unicode) else value
+                    for value in (row[field] for field in FIELDS)])
+
+
+def _keep_started_from(queryset):
+    """Excludes the transition each open transition was started from, i.e.
+    the latest other transition of its system started at or before it.
+    """
+    qn = connections[queryset.db].ops.quote_name
+    system = qn(System._meta.db_table)
+    trans = qn(Transition._meta.db_table)
+
+    return queryset.extra(where=['NOT EXISTS (SELECT 1 FROM {system} s '
+        'INNER JOIN {trans} o ON o.id = s.open_transition_id '
+        'WHERE s.id = {trans}.system_id '
+        'AND o.start_time >= {trans}.start_time '
+        'AND NOT EXISTS (SELECT 1 FROM {trans} n '
+            'WHERE n.system_id = s.id AND n.id <> o.id '
+            'AND n.start_time <= o.start_time '
+            'AND (n.start_time > {trans}.start_time '
+                'OR n.start_time = {trans}.start_time '
+                'AND n.id > {trans}.id)))'.format(system=system, trans=trans)])
+
+
+def archive_transitions(out, format='ndjson', policy=None, batch_size=1000,
+        progress=None, using=None, now=None):
+
+    """Archives and deletes transitions per the retention policy.
+
+    Each batch of at most `batch_size` transitions is written to the file
+    object `out` and deleted in its own transaction, so locks are short
+    lived. A batch is written before it is deleted, so an interruption may
+    leave a batch in both the archive and the table. `progress` is called
+    after each batch with the total number of transitions archived and the
+    elapsed seconds. Returns the number of transitions archived.
+    """
+    if now is None:
+        now = timezone.now()
+
+    writer = Writer(out, format)
+    manager = Transition.objects.db_manager(using)
+    transition_state = State.transition_state(using)
+
+    start = time.time()
+    total = 0
+
+    for filters, excludes, days in get_policy(policy):
+        queryset = manager.filter(start_time__lt=now - timedelta(days=days),
+            **filters).exclude(state=transition_state)
+
+        # Keep the latest transition of each system
+        queryset = queryset.filter(
+            start_time__lt=F('system__last_transition_time'))
+        queryset = _keep_started_from(queryset)
+
+        if excludes:
+            queryset = queryset.exclude(**excludes)
+
+        while True:
+            with transaction.commit_on_success(using=using):
+                rows = list(queryset.order_by('id')
+                    .values(*FIELDS)[:batch_size])
+
+                if not rows:
+                    break
+
+                writer.write(rows)
+                manager.filter(pk__in=[row['id'] for row in rows]).delete()
+
+                # Decrement the counters, grouped by the decrement
+                counts = {}
+                for row in rows:
+                    counts[row['system']] = counts.get(row['system'], 0) + 1
+
+                systems = {}
+                for pk, count in counts.items():
+                    systems.setdefault(count, []).append(pk)
+
+                for count, pks in systems.items():
+                    System.objects.db_manager(using).filter(pk__in=pks)\
+                        .update(transition_count=F('transition_count') - count)
+
+            total += len(rows)
+
+            if progress:
+                progress(total, time.time() - start)
+
+    return total
@@ -0,0 +1,241 @@
+import time
+import atexit
+import logging
+import threading
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+from .models import (System, State, Event, Transition, STSError,
+    DEFAULT_BATCH_SIZE)
+from .signals import sends_signals
+from .utils import get_duration
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class TransitionBuffer(object):
+    """Queues complete transitions in-process and writes them to the database
+    in batches from a background thread.
+
+    A batch is written once `batch_size` transitions are queued or `interval`
+    seconds have passed since the first one was. When the queue holds
+    `max_size` transitions, producers block for up to `timeout` seconds
+    (forever if None) after which the transition is dropped and counted.
+    Queued transitions are written on `close`, which runs at exit for the
+    default buffer. If `threaded` is False, no thread is started and
+    transitions are only written by calling `flush`.
+    """
+    def __init__(self, max_size=10000, batch_size=DEFAULT_BATCH_SIZE,
+            interval=1.0, timeout=None, threaded=True):
+
+        self.threaded = threaded
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.flushes = 0
+        self.flush_time = 0.0
+        self.last_flush_time = None
+
+        self._queue = queue.Queue(max_size)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self.threaded and self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name='sts-transition-buffer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def transition(self, obj, state, event=None, start_time=None,
+            end_time=None, message=None, failed=False):
+
+        """Queues a complete transition for `obj`.
+
+        Nothing is resolved or written in the calling thread, `obj` may be
+        anything `System.get` accepts.
+        """
+        if state is None:
+            raise STSError('Cannot create a transition with an empty state.')
+
+        now = timezone.now()
+
+        record = {
+            'obj': obj,
+            'state': state,
+            'event': event,
+            'start_time': start_time or now,
+            'end_time': end_time or now,
+            'message': message,
+            'failed': failed,
+        }
+
+        if self._stopped.is_set():
+            raise RuntimeError('Transition buffer has been closed.')
+
+        self._start()
+
+        try:
+            self._queue.put(record, True, self.timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning('Transition buffer is full, dropped transition '
+                'for {0!r}'.format(obj))
+        else:
+            with self._lock:
+                self.enqueued += 1
+
+    def _drain(self):
+        "Gets up to `batch_size` records waiting at most `interval` seconds."
+        records = []
+        deadline = None
+
+        while len(records) < self.batch_size:
+            if deadline is None:
+                timeout = self.interval
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+            try:
+                records.append(self._queue.get(True, timeout))
+            except queue.Empty:
+                break
+            if deadline is None:
+                deadline = time.time() + self.interval
+
+        return records
+
+    def _run(self):
+        while not self._stopped.is_set() or not self._queue.empty():
+            records = self._drain()
+            if records:
+                self._write(records, close=True)
+
+    def _write(self, records, close=False):
+        start = time.time()
+
+        try:
+            self._commit(records)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            logger.exception('Failed to write {0} buffered '
+                'transitions'.format(len(records)))
+        finally:
+            # Do not hold on to connections in the background thread
+            # between batches
+            if close:
+                for connection in connections.all():
+                    connection.close()
+
+        elapsed = time.time() - start
+
+        with self._lock:
+            self.flushes += 1
+            self.flush_time += elapsed
+            self.last_flush_time = elapsed
+
+    @sends_signals
+    @transaction.commit_on_success
+    def _commit(self, records):
+        self._insert(records)
+
+    def _insert(self, records):
+        systems = System.get_many([record['obj'] for record in records])
+
+        states = dict((name, State.get(name))
+            for name in set(record['state'] for record in records))
+        events = dict((name, Event.get(name))
+            for name in set(record['event'] for record in records))
+
+        # Locked first so no transition can be opened before the insert
+        System.objects._lock_systems(systems, self.batch_size)
+        open_transitions = System.objects._open_transitions(systems,
+            self.batch_size)
+
+        transitions = []
+
+        for system, record in zip(systems, records):
+            if system.pk in open_transitions:
+                logger.warning('Dropped buffered transition for {0!r}, it is '
+                    'already in transition'.format(record['obj']))
+                with self._lock:
+                    self.dropped += 1
+                continue
+
+            transitions.append(Transition(system=system,
+                state=states[record['state']], event=events[record['event']],
+                start_time=record['start_time'], end_time=record['end_time'],
+                duration=get_duration(record['start_time'], record['end_time']),
+                message=record['message'], failed=record['failed']))
+
+        System.objects._insert_transitions(transitions, self.batch_size)
+
+        with self._lock:
+            self.written += len(transitions)
+
+    def flush(self):
+        "Writes all currently queued transitions in the calling thread."
+        while True:
+            records = []
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not records:
+                break
+            self._write(records)
+
+    def close(self, timeout=None):
+        "Stops accepting transitions and waits for the queue to drain."
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        "Returns a dict of counters suitable for exposing as metrics."
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'flushes': self.flushes,
+                'last_flush_time': self.last_flush_time,
+                'avg_flush_time': self.flushes and self.flush_time / self.flushes,
+            }
+
+
+_default_buffer = None
+_default_lock = threading.Lock()
+
+
+def get_default_buffer():
+    """Returns the process-wide buffer configured by the `STS_BUFFER` setting,
+    a dict of `TransitionBuffer` keyword arguments.
+    """
+    global _default_buffer
+    with _default_lock:
+        if _default_buffer is None:
+            _default_buffer = TransitionBuffer(**getattr(settings,
+                'STS_BUFFER', {}))
+            atexit.register(_default_buffer.close)
+        return _default_buffer
@@ -0,0 +1,128 @@
+import threading
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+
+# Default number of names held in each process-local cache. A size of zero
+# disables caching all together.
+DEFAULT_SIZE = 0
+
+
+class NameCache(object):
+    """Bounded least-recently-used mapping of names to model instances.
+
+    The cache is process-local, but can optionally be backed by one of
+    Django's cache backends (set by `STS_NAME_CACHE_BACKEND`) so the
+    name => pk mapping is shared across workers. The size is set by
+    `STS_NAME_CACHE_SIZE` and is read lazily so it can be changed at runtime.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+        post_save.connect(self._invalidate, sender=model,
+            dispatch_uid='sts-name-cache-save-{0}'.format(model.__name__))
+        post_delete.connect(self._invalidate, sender=model,
+            dispatch_uid='sts-name-cache-delete-{0}'.format(model.__name__))
+
+    @property
+    def size(self):
+        return getattr(settings, 'STS_NAME_CACHE_SIZE', DEFAULT_SIZE)
+
+    @property
+    def backend(self):
+        alias = getattr(settings, 'STS_NAME_CACHE_BACKEND', None)
+        if alias:
+            from django.core.cache import get_cache
+            return get_cache(alias)
+
+    def _key(self, name):
+        return u'sts:{0}:{1}'.format(self.model._meta.object_name.lower(),
+            name).encode('utf-8')
+
+    def get(self, name):
+        "Returns the cached instance for `name` or None."
+        if not self.size:
+            return
+
+        with self._lock:
+            instance = self._data.pop(name, None)
+            if instance is not None:
+                self._data[name] = instance
+                self.hits += 1
+                return instance
+
+        backend = self.backend
+        if backend is not None:
+            pk = backend.get(self._key(name))
+            if pk is not None:
+                instance = self.model(pk=pk, name=name)
+                self._store(name, instance)
+                with self._lock:
+                    self.hits += 1
+                return instance
+
+        with self._lock:
+            self.misses += 1
+
+    def set(self, instance):
+        "Adds `instance` to the cache keyed by its name."
+        if not self.size:
+            return
+        self._store(instance.name, instance)
+
+        backend = self.backend
+        if backend is not None:
+            backend.set(self._key(instance.name), instance.pk)
+
+    def _store(self, name, instance):
+        size = self.size
+        with self._lock:
+            self._data.pop(name, None)
+            self._data[name] = instance
+            while len(self._data) > size:
+                del self._data[next(iter(self._data))]
+                self.evictions += 1
+
+    def delete(self, name):
+        with self._lock:
+            self._data.pop(name, None)
+
+        backend = self.backend
+        if backend is not None:
+            backend.delete(self._key(name))
+
+    def clear(self):
+        "Clears the local cache. Shared backend entries are left untouched."
+        with self._lock:
+            self._data.clear()
+
+    def _invalidate(self, sender, instance, **kwargs):
+        # The instance may have been renamed, so remove any entry that
+        # refers to the same row as well as the entry for the new name.
+        with self._lock:
+            stale = [name for name, cached in self._data.items()
+                if cached.pk == instance.pk]
+        for name in stale:
+            self.delete(name)
+        self.delete(instance.name)
+
+    def stats(self):
+        "Returns a dict of counters suitable for exposing as metrics."
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -1,22 +1,81 @@
-from .models import System
+import logging
+from functools import wraps
+from django.utils import timezone
+from . import aio
+from .models import System, Transition
 
 
+logger = logging.getLogger(__name__)
+
 class transition(object):
-    "Transition context manager."
+    """Transition context manager.
+
+    If `deferred` is True, nothing is written on enter. The start time is
+    captured in-process and the complete transition is written on exit by
+    `System.transition` in one transaction (getting the system, locking it,
+    inserting the transition and updating its snapshot).
+
+    If `buffer` is True (for the default buffer) or a `TransitionBuffer`,
+    nothing is written on enter either and the complete transition is queued
+    on exit to be written in a batch.
+
+    An instance can also decorate a function, each call is then wrapped in
+    its own transition. In a coroutine use `async with`, the database work
+    then runs in the `sts.aio` thread pool.
+    """
     def __init__(self, obj, state, event=None, start_time=None,
-            message=None, exception_fail=True, fail_state='Fail'):
+            message=None, exception_fail=True, fail_state='Fail',
+            buffer=None, deferred=False):
+
+        if buffer is True:
+            from .buffer import get_default_buffer
+            buffer = get_default_buffer()
+
+        self.obj = obj
+        self.event = event
+        self.buffer = buffer
+        self.deferred = deferred
+        self.start_time = start_time
 
-        self.system = System.get(obj)
-        self.transition = self.system.start_transition(event=event,
-            start_time=start_time)
         self.state = state
         self.message = message
         self.exception_fail = exception_fail
         self.fail_state = fail_state
 
+        self.system = None
+        self.transition = None
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            # A copy per call so concurrent and nested calls are independent
+            with type(self)(self.obj, self.state, event=self.event,
+                    start_time=self.start_time, message=self.message,
+                    exception_fail=self.exception_fail,
+                    fail_state=self.fail_state, buffer=self.buffer,
+                    deferred=self.deferred):
+                return func(*args, **kwargs)
+        return wrapper
+
     def __enter__(self):
+        if self.buffer is None and not self.deferred:
+            self.system = System.get(self.obj)
+            self.transition = self.system.start_transition(event=self.event,
+                start_time=self.start_time)
+        else:
+            self.transition = Transition(start_time=self.start_time or
+                timezone.now())
         return self.transition
 
+    def __aenter__(self):
+        # Nothing to write on enter in the deferred and buffered modes
+        if self.buffer is None and not self.deferred:
+            return aio.run(self.__enter__)
+        return aio.done(self.__enter__())
+
+    def __aexit__(self, exc_type, exc_value, traceback):
+        return aio.run(self.__exit__, exc_type, exc_value, traceback)
+
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_type and self.exception_fail:
             failed = True
@@ -27,5 +86,27 @@ class transition(object):
         message = self.transition.message or self.message
         state = self.fail_state if failed else self.state
 
+        try:
+            self._write(state, message, failed)
+        except Exception:
+            if exc_type is None:
+                raise
+            # Do not mask the exception raised in the block
+            logger.exception('Failed to write the transition of {0!r} '
+                'while handling {1!r}'.format(self.obj, exc_value))
+
+    def _write(self, state, message, failed):
+        if self.buffer is not None:
+            self.buffer.transition(self.obj, state, event=self.event,
+                start_time=self.transition.start_time, message=message,
+                failed=failed)
+            return
+
+        if self.deferred:
+            System.get(self.obj).transition(state, event=self.event,
+                start_time=self.transition.start_time, message=message,
+                failed=failed)
+            return
+
         # End the transition
         self.system.end_transition(state, message=message, failed=failed)
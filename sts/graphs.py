@@ -0,0 +1,138 @@
+"""Declarative graphs of the allowed transitions.
+
+The `STS_TRANSITION_GRAPHS` setting maps a content type ('app_label.model',
+i.e. any key containing a dot) or a system name to the events allowed from
+each state and the state each one leads to. None stands for no state (a
+system without transitions) or no event:
+
+    STS_TRANSITION_GRAPHS = {
+        'tests.door': {
+            None: {'Install': 'Closed'},
+            'Closed': {'Open': 'Opened', 'Lock': 'Locked'},
+            'Opened': {'Close': 'Closed'},
+            'Locked': {'Unlock': 'Closed'},
+        },
+    }
+
+Systems without a graph accept any transition. The graphs are compiled per
+database into an index keyed by state and event ids on first use (or by
+calling `compile_graphs` at startup), creating the states and events they
+name, so validating a transition does not query the database.
+"""
+import threading
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS
+from django.test.signals import setting_changed
+from .utils import is_committed
+
+_graphs = {}
+_lock = threading.Lock()
+
+
+class Graph(object):
+    "Adjacency index of a graph, {from state id: {event id: edge}}."
+    def __init__(self, edges):
+        self.edges = edges
+
+    def target(self, state_id, event_id):
+        "Returns the id of the state the event leads to, None if not allowed."
+        edge = self.edges.get(state_id, {}).get(event_id)
+        if edge is not None:
+            return edge[0]
+
+    def allows(self, state_id, event_id):
+        return event_id in self.edges.get(state_id, {})
+
+    def events(self, state_id):
+        "Returns a dict of the allowed event names and the state they lead to."
+        return dict((event, name) for pk, event, name in
+            self.edges.get(state_id, {}).values())
+
+
+def _compile(states, using, created):
+    from .models import State, Event, _get_or_create
+
+    def resolve(klass, name):
+        if name is None:
+            return
+        try:
+            return klass.objects.db_manager(using).filter(name=name)\
+                .order_by('pk')[0]
+        except IndexError:
+            created.append(name)
+            return _get_or_create(klass, using=using, name=name)
+
+    edges = {}
+
+    for from_state, events in states.items():
+        from_state = resolve(State, from_state)
+        edges_from = edges.setdefault(from_state and from_state.pk, {})
+
+        for event, to_state in events.items():
+            event = resolve(Event, event)
+            to_state = resolve(State, to_state)
+            edges_from[event and event.pk] = (to_state.pk,
+                event and event.name, to_state.name)
+
+    return Graph(edges)
+
+
+def compile_graphs(using=None):
+    """Compiles the graphs of the `STS_TRANSITION_GRAPHS` setting for the
+    database and returns them as two dicts keyed by content type id and
+    system name.
+
+    Like `State.transition_state`, the graphs are only cached once all of
+    their states and events have been read outside of a transaction with
+    uncommitted writes since rows created in it may still be rolled back.
+    """
+    using = using or DEFAULT_DB_ALIAS
+
+    with _lock:
+        if using in _graphs:
+            return _graphs[using]
+
+        committed = is_committed(using)
+        by_content_type = {}
+        by_name = {}
+        created = []
+
+        config = getattr(settings, 'STS_TRANSITION_GRAPHS', {})
+
+        for key, states in config.items():
+            graph = _compile(states, using, created)
+            if '.' in key:
+                app_label, model = key.split('.', 1)
+                content_type = ContentType.objects.db_manager(using)\
+                    .get_by_natural_key(app_label, model.lower())
+                by_content_type[content_type.pk] = graph
+            else:
+                by_name[key] = graph
+
+        if not created and committed:
+            _graphs[using] = by_content_type, by_name
+
+        return by_content_type, by_name
+
+
+def get_graph(system):
+    "Returns the graph of the system, None if it has none."
+    if not getattr(settings, 'STS_TRANSITION_GRAPHS', None):
+        return
+
+    by_content_type, by_name = compile_graphs(system._state.db)
+
+    if system.content_type_id:
+        return by_content_type.get(system.content_type_id)
+    return by_name.get(system.name)
+
+
+def reset(**kwargs):
+    "Discards the compiled graphs, e.g. when the setting changes."
+    if kwargs.get('setting', 'STS_TRANSITION_GRAPHS') == \
+            'STS_TRANSITION_GRAPHS':
+        with _lock:
+            _graphs.clear()
+
+setting_changed.connect(reset)
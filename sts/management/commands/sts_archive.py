@@ -0,0 +1,54 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from sts.archive import archive_transitions, open_archive, FORMATS
+
+
+class Command(BaseCommand):
+    help = ('Archives and deletes transitions older than the retention '
+        'policy set by STS_RETENTION.')
+
+    args = '<path>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format',
+            default='ndjson', help='Archive format, one of {0}. Paths ending '
+                'with .gz are compressed.'.format(', '.join(FORMATS))),
+        make_option('--days', action='store', dest='days', type='int',
+            help='Retention in days for all systems, overriding '
+                'STS_RETENTION.'),
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=1000, help='Transitions deleted per '
+                'transaction.'),
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database. Defaults '
+                'to the "default" database.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Specify the path of the archive file.')
+
+        verbosity = int(options.get('verbosity', 1))
+
+        policy = None
+        if options.get('days') is not None:
+            policy = {'default': options['days']}
+
+        def progress(count, elapsed):
+            if verbosity > 1:
+                self.stdout.write('Archived {0} transitions ({1:.0f}/s)\n'
+                    .format(count, count / elapsed if elapsed else 0))
+
+        out = open_archive(args[0])
+        try:
+            count = archive_transitions(out, format=options.get('format'),
+                policy=policy, batch_size=options.get('batch_size'),
+                progress=progress, using=options.get('database'))
+        except ValueError as e:
+            raise CommandError(unicode(e))
+        finally:
+            out.close()
+
+        if verbosity > 0:
+            self.stdout.write('Archived {0} transitions\n'.format(count))
@@ -0,0 +1,27 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction, DEFAULT_DB_ALIAS
+from sts.models import System
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the System snapshot columns from existing transitions.'
+
+    args = '[system_id system_id ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to rebuild. '
+                'Defaults to the "default" database.'),
+    )
+
+    def handle(self, *pks, **options):
+        using = options.get('database')
+        verbosity = int(options.get('verbosity', 1))
+
+        with transaction.commit_on_success(using=using):
+            count = System.objects.db_manager(using)\
+                .rebuild_snapshots(pks=[int(pk) for pk in pks] or None)
+
+        if verbosity > 0:
+            self.stdout.write('Rebuilt {0} system(s)\n'.format(count))
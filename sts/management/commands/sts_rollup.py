@@ -0,0 +1,64 @@
+from datetime import timedelta
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from sts import rollups
+
+
+def _parse(value, name):
+    if value is None:
+        return
+    dt = parse_datetime(value)
+    if dt is None:
+        raise CommandError('Invalid {0} datetime: {1}'.format(name, value))
+    return dt
+
+
+class Command(BaseCommand):
+    help = ('Backfills the hourly transition rollups and compacts old hourly '
+        'rollups into daily rollups.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--backfill', action='store_true', dest='backfill',
+            default=False, help='Rebuild the hourly rollups from the '
+                'transitions between --since and --until.'),
+        make_option('--since', action='store', dest='since',
+            help='Start of the backfill window (ISO 8601).'),
+        make_option('--until', action='store', dest='until',
+            help='End of the backfill window (ISO 8601).'),
+        make_option('--compact', action='store', dest='compact', type='int',
+            help='Merge hourly rollups older than this many days into '
+                'daily rollups.'),
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database. Defaults '
+                'to the "default" database.'),
+    )
+
+    def handle(self, **options):
+        using = options.get('database')
+        verbosity = int(options.get('verbosity', 1))
+
+        if not options.get('backfill') and options.get('compact') is None:
+            raise CommandError('Specify --backfill and/or --compact.')
+
+        if options.get('backfill'):
+            def progress(count):
+                if verbosity > 1:
+                    self.stdout.write('Read {0} transitions\n'.format(count))
+
+            count = rollups.backfill(since=_parse(options.get('since'), 'since'),
+                until=_parse(options.get('until'), 'until'), using=using,
+                progress=progress)
+
+            if verbosity > 0:
+                self.stdout.write('Backfilled rollups from {0} '
+                    'transitions\n'.format(count))
+
+        if options.get('compact') is not None:
+            before = timezone.now() - timedelta(days=options['compact'])
+            count = rollups.compact(before, using=using)
+
+            if verbosity > 0:
+                self.stdout.write('Compacted {0} hourly rollups\n'.format(count))
@@ -0,0 +1,37 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction, DEFAULT_DB_ALIAS
+from sts.models import System
+
+
+class Command(BaseCommand):
+    help = ('Reconciles the transition counter of each System with the '
+        'actual number of transitions.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--fix', action='store_true', dest='fix', default=False,
+            help='Rebuild the snapshots of the systems that differ.'),
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database. Defaults '
+                'to the "default" database.'),
+    )
+
+    def handle(self, **options):
+        using = options.get('database')
+        verbosity = int(options.get('verbosity', 1))
+        manager = System.objects.db_manager(using)
+
+        mismatches = manager.verify_counts()
+
+        if verbosity > 1:
+            for pk, counter, actual in mismatches:
+                self.stdout.write('System {0}: counter {1}, actual {2}\n'
+                    .format(pk, counter, actual))
+
+        if mismatches and options.get('fix'):
+            with transaction.commit_on_success(using=using):
+                manager.rebuild_snapshots([pk for pk, c, a in mismatches])
+
+        if verbosity > 0:
+            self.stdout.write('{0} system(s) {1}\n'.format(len(mismatches),
+                'fixed' if options.get('fix') else 'differ'))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Computes the System snapshot columns added in 0008."
+        qn = db.quote_name
+
+        system = qn(orm['sts.System']._meta.db_table)
+        trans = qn(orm['sts.Transition']._meta.db_table)
+
+        latest = ('(SELECT t.{0} FROM {1} t WHERE t.system_id = {2}.id '
+            'ORDER BY t.start_time DESC, t.id DESC LIMIT 1)')
+
+        sql = ('UPDATE {system} SET '
+            'last_state_id = {last_state}, '
+            'last_failed = {last_failed}, '
+            'last_transition_time = (SELECT MAX(t.start_time) FROM {trans} t '
+                'WHERE t.system_id = {system}.id), '
+            'transition_count = (SELECT COUNT(*) FROM {trans} t '
+                'WHERE t.system_id = {system}.id), '
+            'open_transition_id = (SELECT MAX(t.id) FROM {trans} t '
+                'WHERE t.system_id = {system}.id AND t.state_id IN '
+                '(SELECT s.id FROM {state} s WHERE s.name = %s))').format(
+            system=system, trans=trans,
+            state=qn(orm['sts.State']._meta.db_table),
+            last_state=latest.format('state_id', trans, system),
+            last_failed=latest.format('failed', trans, system))
+
+        db.execute(sql, ['(In Transition)'])
+
+    def backwards(self, orm):
+        "The columns are dropped by 0008."
+
+    models = {
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'sts.event': {
+            'Meta': {'object_name': 'Event'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'sts.state': {
+            'Meta': {'object_name': 'State'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'sts.system': {
+            'Meta': {'ordering': "('-modified',)", 'object_name': 'System'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']", 'null': 'True', 'blank': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'last_state': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': u"orm['sts.State']"}),
+            'last_failed': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'last_transition_time': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'open_transition': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': u"orm['sts.Transition']"}),
+            'transition_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        },
+        u'sts.transition': {
+            'Meta': {'ordering': "('start_time',)", 'object_name': 'Transition'},
+            'duration': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'end_time': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'event': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'transitions'", 'null': 'True', 'to': u"orm['sts.Event']"}),
+            'failed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'message': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'start_time': ('django.db.models.fields.DateTimeField', [], {}),
+            'state': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'transitions'", 'to': u"orm['sts.State']"}),
+            'system': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'transitions'", 'to': u"orm['sts.System']"})
+        }
+    }
+
+    complete_apps = ['sts']
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+# Backends that support partial indexes for enforcing a single open
+# transition per system.
+PARTIAL_INDEX_BACKENDS = ('postgres', 'sqlite3')
+
+OPEN_TRANSITION_INDEX = 'sts_transition_one_open_per_system'
+
+# State of the duplicate open transitions ended before creating the index
+FAIL_STATE_NAME = 'Fail'
+
+
+class Migration(SchemaMigration):
+
+    def end_duplicate_open_transitions(self, orm):
+        """Ends all but the latest open transition of each system as failed,
+        the unique index allows a single one. These are left behind by the
+        concurrent starts the index prevents.
+        """
+        Transition = orm['sts.Transition']
+        State = orm['sts.State']
+
+        system_ids = [row['system'] for row in Transition.objects
+            .filter(end_time__isnull=True).order_by().values('system')
+            .annotate(count=models.Count('id')).filter(count__gt=1)]
+
+        if not system_ids:
+            return
+
+        try:
+            fail_state = State.objects.filter(name=FAIL_STATE_NAME)\
+                .order_by('pk')[0]
+        except IndexError:
+            fail_state = State.objects.create(name=FAIL_STATE_NAME)
+
+        for system_id in system_ids:
+            pks = list(Transition.objects.filter(system=system_id,
+                end_time__isnull=True).order_by('-start_time', '-id')
+                .values_list('pk', flat=True))
+
+            Transition.objects.filter(pk__in=pks[1:]).update(state=fail_state,
+                failed=True, end_time=models.F('start_time'), duration=0,
+                message='Ended by a migration, the system had more than one '
+                    'open transition.')
+
+            latest = Transition.objects.filter(system=system_id)\
+                .order_by('-start_time', '-id')[0]
+            orm['sts.System'].objects.filter(pk=system_id).update(
+                last_state=latest.state_id, last_failed=latest.failed,
+                open_transition=pks[0])
+
+    def forwards(self, orm):
+        if not db.dry_run:
+            self.end_duplicate_open_transitions(orm)
+
+        # Adding index on 'Transition', fields ['system', 'start_time']
+        db.create_index(u'sts_transition', ['system_id', 'start_time'])
+
+        # Adding index on 'Transition', fields ['system', 'state']
+        db.create_index(u'sts_transition', ['system_id', 'state_id'])
+
+        # Open transitions are the only ones without an end time
+        if db.backend_name in PARTIAL_INDEX_BACKENDS:
+            db.execute('CREATE UNIQUE INDEX {0} ON sts_transition (system_id) '
+                'WHERE end_time IS NULL'.format(OPEN_TRANSITION_INDEX))
+
+    def backwards(self, orm):
+        if db.backend_name in PARTIAL_INDEX_BACKENDS:
+            db.execute('DROP INDEX {0}'.format(OPEN_TRANSITION_INDEX))
+
+        # Removing index on 'Transition', fields ['system', 'state']
+        db.delete_index(u'sts_transition', ['system_id', 'state_id'])
+
+        # Removing index on 'Transition', fields ['system', 'start_time']
+        db.delete_index(u'sts_transition', ['system_id', 'start_time'])
+
+    models = {
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'sts.event': {
+            'Meta': {'object_name': 'Event'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'sts.state': {
+            'Meta': {'object_name': 'State'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'sts.system': {
+            'Meta': {'ordering': "('-modified',)", 'object_name': 'System'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']", 'null': 'True', 'blank': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'last_state': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': u"orm['sts.State']"}),
+            'last_failed': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'last_transition_time': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'open_transition': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': u"orm['sts.Transition']"}),
+            'transition_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        },
+        u'sts.transition': {
+            'Meta': {'ordering': "('start_time',)", 'object_name': 'Transition', 'index_together': "(('system', 'start_time'), ('system', 'state'))"},
+            'duration': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'end_time': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'event': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'transitions'", 'null': 'True', 'to': u"orm['sts.Event']"}),
+            'failed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'message': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'start_time': ('django.db.models.fields.DateTimeField', [], {}),
+            'state': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'transitions'", 'to': u"orm['sts.State']"}),
+            'system': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'transitions'", 'to': u"orm['sts.System']"})
+        }
+    }
+
+    complete_apps = ['sts']
\ No newline at end of file
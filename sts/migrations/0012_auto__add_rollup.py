@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'Rollup'
+        db.create_table(u'sts_rollup', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('bucket', self.gf('django.db.models.fields.CharField')(max_length=10)),
+            ('start_time', self.gf('django.db.models.fields.DateTimeField')()),
+            ('state', self.gf('django.db.models.fields.related.ForeignKey')(related_name='+', to=orm['sts.State'])),
+            ('event', self.gf('django.db.models.fields.related.ForeignKey')(blank=True, related_name='+', null=True, to=orm['sts.Event'])),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(blank=True, related_name='+', null=True, to=orm['contenttypes.ContentType'])),
+            ('count', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('failures', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('duration_count', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('duration_sum', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('duration_min', self.gf('django.db.models.fields.PositiveIntegerField')(null=True, blank=True)),
+            ('duration_max', self.gf('django.db.models.fields.PositiveIntegerField')(null=True, blank=True)),
+            ('histogram', self.gf('django.db.models.fields.TextField')(blank=True)),
+        ))
+        db.send_create_signal(u'sts', ['Rollup'])
+
+        # Adding unique constraint on 'Rollup', fields ['bucket', 'start_time', 'state', 'event', 'content_type']
+        db.create_unique(u'sts_rollup', ['bucket', 'start_time', 'state_id', 'event_id', 'content_type_id'])
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'Rollup', fields ['bucket', 'start_time', 'state', 'event', 'content_type']
+        db.delete_unique(u'sts_rollup', ['bucket', 'start_time', 'state_id', 'event_id', 'content_type_id'])
+
+        # Deleting model 'Rollup'
+        db.delete_table(u'sts_rollup')
+
+    models = {
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'sts.event': {
+            'Meta': {'object_name': 'Event'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'sts.rollup': {
+            'Meta': {'ordering': "('start_time',)", 'unique_together': "(('bucket', 'start_time', 'state', 'event', 'content_type'),)", 'object_name': 'Rollup'},
+            'bucket': ('django.db.models.fields.CharField', [], {'max_length': '10'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'to': u"orm['contenttypes.ContentType']"}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'duration_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'duration_max': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'duration_min': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'duration_sum': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'event': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'to': u"orm['sts.Event']"}),
+            'failures': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'histogram': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'start_time': ('django.db.models.fields.DateTimeField', [], {}),
+            'state': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': u"orm['sts.State']"})
+        },
+        u'sts.state': {
+            'Meta': {'object_name': 'State'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'sts.system': {
+            'Meta': {'ordering': "('-modified',)", 'object_name': 'System', 'index_together': "(('modified', 'id'),)"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']", 'null': 'True', 'blank': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'last_state': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': u"orm['sts.State']"}),
+            'last_failed': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'last_transition_time': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'open_transition': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': u"orm['sts.Transition']"}),
+            'transition_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        },
+        u'sts.transition': {
+            'Meta': {'ordering': "('start_time',)", 'object_name': 'Transition', 'index_together': "(('system', 'start_time'), ('system', 'state'))"},
+            'duration': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'end_time': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'event': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'transitions'", 'null': 'True', 'to': u"orm['sts.Event']"}),
+            'failed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'message': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'start_time': ('django.db.models.fields.DateTimeField', [], {}),
+            'state': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'transitions'", 'to': u"orm['sts.State']"}),
+            'system': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'transitions'", 'to': u"orm['sts.System']"})
+        }
+    }
+
+    complete_apps = ['sts']
\ No newline at end of file
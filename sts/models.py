@@ -1,19 +1,65 @@
-from django.db import models, transaction, IntegrityError
+import django
+from django.db import models, transaction, connections, router, \
+    IntegrityError, DEFAULT_DB_ALIAS
+from django.db.models import F, Q
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.utils import timezone
-from .utils import classproperty, get_duration, get_natural_duration
+from . import aio, graphs, rollups, signals
+from .cache import NameCache
+from .sinks import get_sinks
+from .utils import classproperty, get_duration, get_natural_duration, \
+    trunc_sql, parse_bucket, is_committed
 
 
-def _get_or_create(klass, **kwargs):
+# System fields only written by the transition methods
+SNAPSHOT_FIELDS = ('last_state', 'last_failed', 'last_transition_time',
+    'open_transition', 'transition_count')
+
+
+# Default number of rows written or looked up per query by bulk operations.
+DEFAULT_BATCH_SIZE = 500
+
+# Name of the sentinel state of open transitions
+TRANSITION_STATE_NAME = '(In Transition)'
+
+
+def _get_first(klass, using=None, **kwargs):
+    """Returns the oldest matching row. Names are not unique, concurrent
+    first uses may create duplicates.
+    """
+    try:
+        return klass.objects.db_manager(using).filter(**kwargs)\
+            .order_by('pk')[0]
+    except IndexError:
+        raise klass.DoesNotExist
+
+
+def _get_or_create(klass, using=None, **kwargs):
     "Mimic logic Manager.get_or_create without savepoints"
     try:
-        return klass.objects.get(**kwargs)
+        return _get_first(klass, using=using, **kwargs)
     except klass.DoesNotExist:
         try:
-            return klass.objects.create(**kwargs)
+            return klass.objects.db_manager(using).create(**kwargs)
         except IntegrityError:
-            return klass.objects.get(**kwargs)
+            return _get_first(klass, using=using, **kwargs)
+
+
+def _get_by_name(klass, name):
+    "Gets or creates an instance by name going through the name cache."
+    instance = klass.cache.get(name)
+    if instance is None:
+        committed = is_committed(router.db_for_read(klass))
+        try:
+            instance = _get_first(klass, name=name)
+        except klass.DoesNotExist:
+            # Newly created rows are not cached since the enclosing
+            # transaction may still be rolled back.
+            return _get_or_create(klass, name=name)
+        if committed:
+            klass.cache.set(instance)
+    return instance
 
 
 class STSError(Exception):
@@ -27,11 +73,41 @@ class State(models.Model):
     def __unicode__(self):
         return self.name
 
+    # Sentinel transition states keyed by database alias
+    _transition_states = {}
+
     @classproperty
     def TRANSITION(cls):
-        if not hasattr(cls, '_transition'):
-            cls._transition = cls.objects.get(pk=1)
-        return cls._transition
+        return cls.transition_state()
+
+    @classmethod
+    def transition_state(cls, using=None):
+        """Returns the sentinel state of open transitions for the database
+        alias (the alias the router picks for writes by default).
+
+        The state is looked up by name and created on demand. It is resolved
+        once per alias, but only cached once it has been read outside of a
+        transaction with uncommitted writes since a row created in that
+        transaction may still be rolled back.
+        """
+        if using is None:
+            using = router.db_for_write(cls)
+
+        state = cls._transition_states.get(using)
+
+        if state is None:
+            committed = is_committed(using)
+            manager = cls.objects.db_manager(using)
+            try:
+                state = manager.filter(name=TRANSITION_STATE_NAME)\
+                    .order_by('pk')[0]
+            except IndexError:
+                return _get_or_create(cls, using=using,
+                    name=TRANSITION_STATE_NAME)
+            if committed:
+                cls._transition_states[using] = state
+
+        return state
 
     @classmethod
     def get(cls, name):
@@ -41,7 +117,12 @@ class State(models.Model):
             return name
         if isinstance(name, int):
             return cls.objects.get(pk=name)
-        return _get_or_create(cls, name=name)
+        return _get_by_name(cls, name)
+
+    @classmethod
+    def aget(cls, name):
+        "Returns a future of `get` for use in coroutines."
+        return aio.run(cls.get, name)
 
 
 class Event(models.Model):
@@ -59,7 +140,357 @@ class Event(models.Model):
             return name
         if isinstance(name, int):
             return cls.objects.get(pk=name)
-        return _get_or_create(cls, name=name)
+        return _get_by_name(cls, name)
+
+    @classmethod
+    def aget(cls, name):
+        "Returns a future of `get` for use in coroutines."
+        return aio.run(cls.get, name)
+
+
+class SystemManager(models.Manager):
+    def rebuild_snapshots(self, pks=None, batch_size=DEFAULT_BATCH_SIZE,
+            modified=None):
+
+        """Recomputes the snapshot columns from the existing transitions.
+
+        If `pks` is None, every system is rebuilt. If `modified` is given,
+        the modified time of the systems is set to it. Returns the number of
+        systems updated.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+
+        system = qn(System._meta.db_table)
+        trans = qn(Transition._meta.db_table)
+
+        latest = ('(SELECT t.{0} FROM {1} t WHERE t.system_id = {2}.id '
+            'ORDER BY t.start_time DESC, t.id DESC LIMIT 1)')
+
+        sql = ('UPDATE {system} SET '
+            'last_state_id = {last_state}, '
+            'last_failed = {last_failed}, '
+            'last_transition_time = (SELECT MAX(t.start_time) FROM {trans} t '
+                'WHERE t.system_id = {system}.id), '
+            'transition_count = (SELECT COUNT(*) FROM {trans} t '
+                'WHERE t.system_id = {system}.id), '
+            'open_transition_id = (SELECT MAX(t.id) FROM {trans} t '
+                'WHERE t.system_id = {system}.id AND t.state_id = %s)').format(
+            system=system, trans=trans,
+            last_state=latest.format('state_id', trans, system),
+            last_failed=latest.format('failed', trans, system))
+
+        params = [State.transition_state(self.db).pk]
+
+        if modified is not None:
+            sql += ', modified = %s'
+            params.append(connection.ops.value_to_db_datetime(modified))
+
+        cursor = connection.cursor()
+
+        if pks is None:
+            cursor.execute(sql, params)
+            count = cursor.rowcount
+        else:
+            pks = list(pks)
+            count = 0
+            for i in xrange(0, len(pks), batch_size):
+                batch = pks[i:i + batch_size]
+                cursor.execute('{0} WHERE {1}.id IN ({2})'.format(sql, system,
+                    ', '.join(['%s'] * len(batch))), params + batch)
+                count += cursor.rowcount
+
+        transaction.commit_unless_managed(using=self.db)
+        return count
+
+    def verify_counts(self, batch_size=DEFAULT_BATCH_SIZE):
+        """Compares the transition counter of each system with the actual
+        number of transitions. Returns a list of (pk, counter, actual) for
+        the systems that differ.
+        """
+        queryset = self.annotate(actual=models.Count('transitions'))\
+            .order_by('pk').values_list('pk', 'transition_count', 'actual')
+
+        mismatches = []
+        last = 0
+
+        while True:
+            rows = list(queryset.filter(pk__gt=last)[:batch_size])
+            if not rows:
+                break
+            mismatches.extend(row for row in rows if row[1] != row[2])
+            last = rows[-1][0]
+
+        return mismatches
+
+    def in_state_at(self, state, when):
+        """Returns the systems that were in `state` (an instance or name) at
+        `when`.
+
+        The latest transition started at or before `when` is selected for
+        each system with a correlated subquery using the (system,
+        start_time) index. A system is only in the state if that transition
+        had ended by then, otherwise it was in transition.
+        """
+        if isinstance(state, State):
+            pks = [state.pk]
+        else:
+            pks = list(State.objects.db_manager(self.db).filter(name=state)
+                .values_list('pk', flat=True))
+            if not pks:
+                return self.none()
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+
+        system = qn(System._meta.db_table)
+        trans = qn(Transition._meta.db_table)
+
+        when = connection.ops.value_to_db_datetime(when)
+
+        # The open transition has its final state once ended, so only the
+        # end time determines whether it was in transition
+        if State.transition_state(self.db).pk in pks:
+            condition = 't.end_time IS NULL OR t.end_time > %s'
+            params = [when, when]
+        else:
+            condition = 't.state_id IN ({0}) AND t.end_time <= %s'.format(
+                ', '.join(['%s'] * len(pks)))
+            params = [when] + pks + [when]
+
+        where = ('EXISTS (SELECT 1 FROM {trans} t WHERE t.id = '
+            '(SELECT t2.id FROM {trans} t2 WHERE t2.system_id = {system}.id '
+                'AND t2.start_time <= %s '
+                'ORDER BY t2.start_time DESC, t2.id DESC LIMIT 1) '
+            'AND ({condition}))').format(trans=trans, system=system,
+                condition=condition)
+
+        return self.extra(where=[where], params=params)
+
+    def _resolve(self, systems):
+        return System.get_many(systems, using=self.db)
+
+    def _lock_systems(self, systems, batch_size):
+        """Locks the rows of the systems for the rest of the transaction, in
+        primary key order to avoid deadlocks.
+        """
+        pks = sorted(set(system.pk for system in systems))
+        queryset = System.objects.db_manager(self.db).select_for_update()\
+            .order_by('pk')
+        for i in xrange(0, len(pks), batch_size):
+            list(queryset.filter(pk__in=pks[i:i + batch_size])
+                .values_list('pk', flat=True))
+
+    def _open_transitions(self, systems, batch_size):
+        "Returns a dict of open transitions keyed by system id."
+        pks = [system.pk for system in systems]
+        queryset = Transition.objects.db_manager(self.db)\
+            .filter(state=State.transition_state(self.db))
+        transitions = {}
+        for i in xrange(0, len(pks), batch_size):
+            for transition in queryset.filter(system__in=pks[i:i + batch_size]):
+                transitions[transition.system_id] = transition
+        return transitions
+
+    def _insert_transitions(self, transitions, batch_size):
+        "Inserts transitions in batches and rebuilds the affected snapshots."
+        manager = Transition.objects.db_manager(self.db)
+        for i in xrange(0, len(transitions), batch_size):
+            manager.bulk_create(transitions[i:i + batch_size])
+        self.rebuild_snapshots(set(t.system_id for t in transitions),
+            batch_size=batch_size, modified=timezone.now())
+
+        if rollups.enabled():
+            rollups.record([t for t in transitions if not t.in_transition()],
+                using=self.db)
+
+        signals.queue(transitions)
+
+    @signals.sends_signals
+    def bulk_transition(self, systems, state, event=None, start_time=None,
+            end_time=None, message=None, failed=False,
+            batch_size=DEFAULT_BATCH_SIZE):
+
+        """Creates the same immediate transition for many systems at once.
+
+        `systems` may contain System instances, names or model objects. The
+        state and event are resolved once, open transitions are checked in
+        batches and the transitions are inserted with `bulk_create`. The
+        system rows are locked first so concurrent writers cannot open a
+        second transition.
+
+        Returns a list of (system, result) pairs in the order given where
+        result is the new Transition or an STSError (also for systems
+        listed more than once). Note, `bulk_create`
+        does not set the primary key of the transitions on most backends.
+        """
+        event = Event.get(event)
+        state = State.get(state)
+
+        if state is None or state == State.transition_state(self.db):
+            raise STSError('Cannot create a transition with an empty state.')
+
+        now = timezone.now()
+
+        if start_time is None:
+            start_time = now
+
+        if end_time is None:
+            end_time = now
+
+        duration = get_duration(start_time, end_time)
+
+        with transaction.commit_on_success(using=self.db):
+            systems = self._resolve(systems)
+            self._lock_systems(systems, batch_size)
+            open_transitions = self._open_transitions(systems, batch_size)
+            seen = set()
+
+            results = []
+            transitions = []
+
+            for system in systems:
+                if system.pk in seen:
+                    results.append((system, STSError('The system is listed '
+                        'more than once.')))
+                    continue
+                seen.add(system.pk)
+
+                if system.pk in open_transitions:
+                    results.append((system, STSError('Cannot start '
+                        'transition while already in one.')))
+                    continue
+
+                transition = Transition(system=system, event=event,
+                    duration=duration, state=state, start_time=start_time,
+                    end_time=end_time, message=message, failed=failed)
+                transitions.append(transition)
+                results.append((system, transition))
+
+            self._insert_transitions(transitions, batch_size)
+
+        return results
+
+    @signals.sends_signals
+    def bulk_start_transition(self, systems, event=None, start_time=None,
+            batch_size=DEFAULT_BATCH_SIZE):
+
+        """Starts a transition for many systems at once.
+
+        Returns a list of (system, result) pairs like `bulk_transition`.
+        """
+        event = Event.get(event)
+        state = State.transition_state(self.db)
+
+        if start_time is None:
+            start_time = timezone.now()
+
+        with transaction.commit_on_success(using=self.db):
+            systems = self._resolve(systems)
+            self._lock_systems(systems, batch_size)
+            open_transitions = self._open_transitions(systems, batch_size)
+            seen = set()
+
+            results = []
+            transitions = []
+
+            for system in systems:
+                if system.pk in seen:
+                    results.append((system, STSError('The system is listed '
+                        'more than once.')))
+                    continue
+                seen.add(system.pk)
+
+                if system.pk in open_transitions:
+                    results.append((system, STSError('Cannot start '
+                        'transition while already in one.')))
+                    continue
+
+                transition = Transition(system=system, event=event,
+                    state=state, start_time=start_time)
+                transitions.append(transition)
+                results.append((system, transition))
+
+            self._insert_transitions(transitions, batch_size)
+
+        return results
+
+    @signals.sends_signals
+    def bulk_end_transition(self, systems, state, end_time=None,
+            message=None, failed=False, batch_size=DEFAULT_BATCH_SIZE):
+
+        """Ends the open transition of many systems at once.
+
+        Transitions sharing a start time (e.g. started together with
+        `bulk_start_transition`) have the same duration and are updated with
+        a single query. Returns a list of (system, result) pairs like
+        `bulk_transition`.
+        """
+        state = State.get(state)
+
+        if end_time is None:
+            end_time = timezone.now()
+
+        with transaction.commit_on_success(using=self.db):
+            systems = self._resolve(systems)
+            self._lock_systems(systems, batch_size)
+            open_transitions = self._open_transitions(systems, batch_size)
+            seen = set()
+
+            results = []
+            durations = {}
+
+            for system in systems:
+                if system.pk in seen:
+                    results.append((system, STSError('The system is listed '
+                        'more than once.')))
+                    continue
+                seen.add(system.pk)
+
+                transition = open_transitions.get(system.pk)
+
+                if transition is None:
+                    results.append((system, STSError('Cannot end a '
+                        'transition while not in one.')))
+                    continue
+
+                # Avoid a query per transition for the rollups and signals
+                transition.system = system
+                transition.duration = get_duration(transition.start_time,
+                    end_time)
+                transition.state = state
+                transition.failed = failed
+                transition.end_time = end_time
+                if message is not None:
+                    transition.message = message
+
+                durations.setdefault(transition.duration, []).append(transition.pk)
+                results.append((system, transition))
+
+            fields = {'state': state, 'failed': failed, 'end_time': end_time}
+            if message is not None:
+                fields['message'] = message
+
+            queryset = Transition.objects.db_manager(self.db).all()
+
+            for duration, pks in durations.items():
+                for i in xrange(0, len(pks), batch_size):
+                    queryset.filter(pk__in=pks[i:i + batch_size])\
+                        .update(duration=duration, **fields)
+
+            ended = [result for system, result in results
+                if isinstance(result, Transition)]
+
+            self.rebuild_snapshots([transition.system_id
+                for transition in ended], batch_size=batch_size,
+                modified=timezone.now())
+
+            if rollups.enabled():
+                rollups.record(ended, using=self.db)
+
+            signals.queue(ended)
+
+        return results
 
 
 class System(models.Model):
@@ -73,11 +504,29 @@ class System(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
 
+    # Snapshot of the latest transition. These are maintained by the
+    # transition methods so reads do not need to query the transitions.
+    # Use `System.objects.rebuild_snapshots` if transitions are written by
+    # other means.
+    last_state = models.ForeignKey(State, null=True, blank=True,
+        related_name='+', on_delete=models.SET_NULL)
+    last_failed = models.NullBooleanField()
+    last_transition_time = models.DateTimeField(null=True, blank=True)
+    open_transition = models.ForeignKey('Transition', null=True, blank=True,
+        related_name='+', on_delete=models.SET_NULL)
+    transition_count = models.PositiveIntegerField(default=0)
+
     content_object = generic.GenericForeignKey()
 
+    objects = SystemManager()
+
     class Meta(object):
         ordering = ('-modified',)
 
+        # Supports keyset pagination of the systems list
+        if django.VERSION >= (1, 5):
+            index_together = (('modified', 'id'),)
+
     def __unicode__(self):
         if self.name:
             return self.name
@@ -92,57 +541,101 @@ class System(models.Model):
         return True
 
     def __iter__(self):
-        for transition in self.transitions.iterator():
-            yield transition
+        return self.iter_transitions()
+
+    def iter_transitions(self, chunk_size=DEFAULT_BATCH_SIZE, related=False,
+            after=None):
+
+        """Iterates over the transitions in order of start time.
+
+        The transitions are fetched in chunks of `chunk_size` keyed by
+        (start_time, id), so memory use is constant and no cursor is held
+        open between chunks. If `related` is True, the state and event are
+        selected along with the transitions. Iteration can be resumed after
+        a transition by passing its (start_time, id) as `after`.
+        """
+        queryset = self.transitions.order_by('start_time', 'id')
+
+        if related:
+            queryset = queryset.select_related('state', 'event')
+
+        while True:
+            chunk = queryset
+
+            if after is not None:
+                start_time, pk = after
+                chunk = chunk.filter(Q(start_time__gt=start_time) |
+                    Q(start_time=start_time, id__gt=pk))
+
+            chunk = list(chunk[:chunk_size])
+
+            for transition in chunk:
+                yield transition
+
+            if len(chunk) < chunk_size:
+                break
+
+            after = (chunk[-1].start_time, chunk[-1].pk)
+
+    def _last_pks(self, stop, start=0):
+        """Returns the pks of the transitions from the end, slicing the
+        reversed transitions by `start` and `stop`, as a subquery.
+        """
+        pks = self.transitions.order_by('-start_time', '-id')\
+            .values_list('pk', flat=True)[start:stop]
+        # MySQL does not support LIMIT in IN subqueries
+        if connections[self._state.db or DEFAULT_DB_ALIAS].vendor == 'mysql':
+            pks = list(pks)
+        return pks
 
-    @transaction.commit_on_success
     def __getitem__(self, idx):
-        queryset = self.transitions.order_by('start_time')
+        """Indexes the transitions in order of start time.
+
+        Slices return lazy querysets which can be iterated in chunks with
+        `iterator()`. Any slice shape is answered by a single query using the
+        (system, start_time) index, negative bounds do not count the
+        transitions.
+        """
+        queryset = self.transitions.order_by('start_time', 'id')
 
         if isinstance(idx, slice):
+            start, stop = idx.start, idx.stop
+
             if idx.step is not None:
                 raise IndexError('Index stepping is not supported.')
 
-            if idx.start is None and idx.stop is None:
+            if start is None and stop is None:
                 raise ValueError('List cloning is not supported.')
 
-            if idx.start is not None and idx.stop is not None:
-                # Backwards..
-                if idx.stop < idx.start  or idx.start < 0 and idx.stop > 0:
-                    return []
+            if start is not None and stop is not None:
+                # Backwards, only comparable when the bounds have the same
+                # sign, e.g. [1:-2] is not backwards
+                if (start < 0) == (stop < 0) and stop < start or \
+                        start < 0 and stop > 0:
+                    return queryset.none()
 
                 # Equal, nothing to do
-                if idx.stop == idx.start:
-                    return []
-
-            # Negative indexing.. QuerySets don't support these, so we take it
-            # from the front and reverse it.
-            if idx.start is not None and idx.start < 0:
-                if idx.stop is None:
-                    start = None
-                    stop = abs(idx.start)
-                else:
-                    start = abs(idx.stop)
-                    stop = abs(idx.stop + idx.start)
-
-                idx = slice(start, stop)
-                trans = list(queryset.order_by('-start_time')[idx])
-                trans.reverse()
-            elif idx.stop is not None and idx.stop < 0:
-                start = idx.start
-                stop = self.length + idx.stop
-                idx = slice(start, stop)
-                trans = list(queryset[idx])
-            else:
-                trans = list(queryset[idx])
-        elif idx < 0:
-            trans = queryset.order_by('-start_time')[abs(idx) - 1]
-        else:
-            try:
-                trans = queryset[idx]
-            except Transition.DoesNotExist:
-                raise IndexError
-        return trans
+                if stop == start:
+                    return queryset.none()
+
+            # Negative indexing.. QuerySets don't support these, so the
+            # transitions are selected from the end in a subquery.
+            if start is not None and start < 0:
+                return queryset.filter(pk__in=self._last_pks(abs(start),
+                    abs(stop or 0)))
+
+            if stop is not None and stop < 0:
+                queryset = queryset.exclude(pk__in=self._last_pks(abs(stop)))
+                return queryset[start:] if start else queryset
+
+            return queryset[idx]
+
+        try:
+            if idx < 0:
+                return queryset.reverse()[abs(idx) - 1]
+            return queryset[idx]
+        except Transition.DoesNotExist:
+            raise IndexError
 
     @classmethod
     def get(cls, obj_or_name, save=True):
@@ -164,34 +657,311 @@ class System(models.Model):
             raise ValueError('Model object has no primary key.')
         ct = ContentType.objects.get_for_model(obj.__class__)
         try:
-            obj = cls.objects.get(content_type=ct, object_id=obj.pk)
+            obj = cls.objects.select_related('last_state')\
+                .get(content_type=ct, object_id=obj.pk)
         except cls.DoesNotExist:
             obj = cls(content_type=ct, object_id=obj.pk)
             if save:
                 obj.save()
         return obj
 
+    @classmethod
+    def aget(cls, obj_or_name, save=True):
+        "Returns a future of `get` for use in coroutines."
+        return aio.run(cls.get, obj_or_name, save=save)
+
+    @classmethod
+    def get_many(cls, objs, create=True, using=None,
+            batch_size=DEFAULT_BATCH_SIZE):
+
+        """Returns a list of System instances for `objs` in the same order.
+
+        Like `get`, `objs` may contain System instances, names or model
+        objects. Model objects are grouped by content type and looked up with
+        one query per type (and batch), names with one query per batch.
+        Missing systems are created with `bulk_create` or, if `create` is
+        False, returned unsaved.
+        """
+        objs = list(objs)
+        manager = cls.objects.db_manager(using)
+
+        names = set()
+        object_ids = {}
+
+        for obj in objs:
+            if isinstance(obj, cls):
+                continue
+            if isinstance(obj, basestring):
+                names.add(obj)
+                continue
+            if not isinstance(obj, models.Model):
+                raise TypeError('This classmethod only supports get Systems for model objects.')
+            if not obj.pk:
+                raise ValueError('Model object has no primary key.')
+            ct = ContentType.objects.get_for_model(obj.__class__)
+            object_ids.setdefault(ct, set()).add(obj.pk)
+
+        def fetch(lookup, values, key, **kwargs):
+            values = list(values)
+            found = {}
+            for i in xrange(0, len(values), batch_size):
+                filters = dict(kwargs, **{lookup: values[i:i + batch_size]})
+                for system in manager.filter(**filters):
+                    found.setdefault(getattr(system, key), system)
+            return found
+
+        def fetch_or_create(lookup, values, key, **kwargs):
+            found = fetch(lookup, values, key, **kwargs)
+            missing = [value for value in values if value not in found]
+
+            if missing:
+                field = lookup.split('__')[0]
+                new = [cls(**dict(kwargs, **{field: value}))
+                    for value in missing]
+
+                if create:
+                    for i in xrange(0, len(new), batch_size):
+                        manager.bulk_create(new[i:i + batch_size])
+                    # bulk_create does not set primary keys
+                    found.update(fetch(lookup, missing, key, **kwargs))
+                else:
+                    found.update((getattr(system, key), system)
+                        for system in new)
+            return found
+
+        systems = {}
+
+        if names:
+            systems.update(fetch_or_create('name__in', names, 'name'))
+
+        for ct, pks in object_ids.items():
+            found = fetch_or_create('object_id__in', pks, 'object_id',
+                content_type=ct)
+            systems.update(((ct.pk, pk), system) for pk, system in found.items())
+
+        results = []
+        for obj in objs:
+            if isinstance(obj, cls):
+                results.append(obj)
+            elif isinstance(obj, basestring):
+                results.append(systems[obj])
+            else:
+                ct = ContentType.objects.get_for_model(obj.__class__)
+                results.append(systems[(ct.pk, obj.pk)])
+        return results
+
     @property
     def length(self):
-        return self.transitions.count()
+        "The number of transitions as maintained by the snapshot."
+        self.refresh_snapshot()
+        return self.transition_count
+
+    def save(self, *args, **kwargs):
+        """Saves the system without its snapshot columns, which are only
+        written by the transition methods, so saving an instance with a
+        stale snapshot does not overwrite a newer one.
+        """
+        if self._state.adding or args or kwargs.get('force_insert') or \
+                kwargs.get('update_fields') is not None:
+            return super(System, self).save(*args, **kwargs)
+
+        if django.VERSION >= (1, 5):
+            kwargs['update_fields'] = [field.name for field in
+                self._meta.local_fields if not field.primary_key and
+                field.name not in SNAPSHOT_FIELDS]
+            return super(System, self).save(*args, **kwargs)
+
+        # No update_fields before Django 1.5, so the snapshot is reloaded
+        # under the row lock and saved back unchanged
+        using = kwargs.get('using') or router.db_for_write(System,
+            instance=self)
+        with transaction.commit_on_success(using=using):
+            self.refresh_snapshot(lock=True, using=using)
+            super(System, self).save(*args, **kwargs)
+
+    def refresh_snapshot(self, lock=False, using=None):
+        """Reloads the snapshot columns from the database. If `lock` is
+        True, the row is locked for the rest of the transaction.
+        """
+        if self.pk is None:
+            return
+
+        queryset = System.objects.db_manager(using or self._state.db)\
+            .filter(pk=self.pk)
+
+        # Rows on the nullable side of a join cannot be locked
+        if lock:
+            queryset = queryset.select_for_update()
+        else:
+            queryset = queryset.select_related('last_state')
 
-    def current_state(self):
         try:
-            return self.transitions.select_related('state')\
-                .latest('start_time').state
-        except Transition.DoesNotExist:
-            pass
+            system = queryset.get()
+        except System.DoesNotExist:
+            return
 
-    def in_transition(self):
-        return self.transitions.filter(state=State.TRANSITION).exists()
+        # Cached related objects may be stale
+        for name in ('last_state', 'open_transition'):
+            self.__dict__.pop(self._meta.get_field(name).get_cache_name(),
+                None)
 
-    def failed_last_transition(self):
+        if lock:
+            self.last_state_id = system.last_state_id
+        else:
+            self.last_state = system.last_state
+
+        self.last_failed = system.last_failed
+        self.last_transition_time = system.last_transition_time
+        self.open_transition_id = system.open_transition_id
+        self.transition_count = system.transition_count
+
+    def current_state(self, refresh=True):
+        """Returns the current state. The snapshot is reloaded from the
+        system row unless `refresh` is False, in which case the snapshot of
+        this instance is read without a query.
+        """
+        if refresh:
+            self.refresh_snapshot()
+        return self.last_state
+
+    def state_at(self, when):
+        """Returns the state the system was in at `when`.
+
+        This is the state of the latest transition started at or before
+        `when`, or the in-transition state if it had not ended by then.
+        None is returned if there were no transitions by then.
+        """
         try:
-            return self.transitions.select_related('state')\
-                .latest('start_time').failed
-        except Transition.DoesNotExist:
-            pass
+            transition = self.transitions.select_related('state')\
+                .filter(start_time__lte=when)\
+                .order_by('-start_time', '-id')[0]
+        except IndexError:
+            return
 
+        if transition.end_time is None or transition.end_time > when:
+            return State.transition_state(self._state.db)
+        return transition.state
+
+    def in_transition(self, refresh=True):
+        "Returns whether the system is in transition, see `current_state`."
+        if refresh:
+            self.refresh_snapshot()
+        return self.open_transition_id is not None
+
+    def failed_last_transition(self, refresh=True):
+        "Returns whether the last transition failed, see `current_state`."
+        if refresh:
+            self.refresh_snapshot()
+        return self.last_failed
+
+    def _lock(self):
+        """Locks the system row for the rest of the transaction and returns
+        the id of its open transition, its last transition time and the id
+        of its current state.
+        """
+        if self.pk is None:
+            return None, None, None
+        return System.objects.select_for_update().filter(pk=self.pk)\
+            .values_list('open_transition', 'last_transition_time',
+                'last_state').get()
+
+    def _check_transition(self, graph, state_id, event_id, to_state_id=None):
+        """Raises STSError if the graph does not allow the event from the
+        state, or does not lead to `to_state_id` if given.
+        """
+        if to_state_id is None:
+            allowed = graph.allows(state_id, event_id)
+        else:
+            allowed = graph.target(state_id, event_id) == to_state_id
+
+        if not allowed:
+            # Only queried for the message
+            names = [pk and klass.objects.get(pk=pk).name for klass, pk in
+                ((State, state_id), (Event, event_id), (State, to_state_id))]
+            raise STSError('Transition from {0} by {1} to {2} is not '
+                'allowed.'.format(*names))
+
+    def allowed_events(self, refresh=True):
+        """Returns a dict of the names of the events allowed in the current
+        state and the name of the state each leads to, or None if the
+        system has no transition graph. No events are allowed while in
+        transition. The graph is compiled once, so with `refresh` False
+        (see `current_state`) this does not query the database.
+        """
+        graph = graphs.get_graph(self)
+        if graph is None:
+            return
+        if refresh:
+            self.refresh_snapshot()
+        if self.in_transition(refresh=False):
+            return {}
+        return graph.events(self.last_state_id)
+
+    def _update_snapshot(self, transition, created=True,
+            last_transition_time=None):
+
+        """Updates the snapshot columns for a newly saved or ended transition.
+
+        The update is conditional on the open transition being the expected
+        one, so concurrent writers that are not serialized by the row lock
+        (e.g. on SQLite) cannot both succeed. STSError is raised for the
+        loser which rolls back its transaction.
+        """
+        queryset = System.objects.filter(pk=self.pk)
+        is_open = transition.in_transition()
+
+        # The systems are listed by their last activity
+        fields = {
+            'open_transition': transition if is_open else None,
+            'modified': timezone.now(),
+        }
+
+        if created:
+            queryset = queryset.filter(open_transition__isnull=True)
+            fields['transition_count'] = F('transition_count') + 1
+        else:
+            queryset = queryset.filter(open_transition=transition)
+
+        latest = {
+            'last_state': transition.state,
+            'last_failed': transition.failed,
+            'last_transition_time': transition.start_time,
+        }
+
+        # Only move the current state forward, transitions may be recorded
+        # with a start time in the past.
+        if created:
+            is_latest = last_transition_time is None or \
+                last_transition_time <= transition.start_time
+            updated = queryset.update(**dict(fields, **latest)
+                if is_latest else fields)
+        else:
+            updated = queryset.filter(Q(last_transition_time__isnull=True) |
+                Q(last_transition_time__lte=transition.start_time))\
+                .update(**dict(fields, **latest))
+            is_latest = bool(updated)
+            if not updated:
+                updated = queryset.update(**fields)
+
+        if not updated:
+            raise STSError('The system was transitioned concurrently.')
+
+        if rollups.enabled() and not is_open:
+            rollups.record([transition], using=self._state.db)
+
+        signals.queue([transition])
+
+        # Keep this instance in sync
+        self.open_transition = fields['open_transition']
+        self.modified = fields['modified']
+        if created:
+            self.transition_count += 1
+        if is_latest:
+            self.last_state = transition.state
+            self.last_failed = transition.failed
+            self.last_transition_time = transition.start_time
+
+    @signals.sends_signals
     @transaction.commit_on_success
     def start_transition(self, event=None, start_time=None, save=True):
         """Creates and starts a transition if one is not already open.
@@ -199,13 +969,23 @@ class System(models.Model):
         For long-running transitions, this method can be used at the start of a
         transition and then later ended with `end_transition`.
         """
-        if self.in_transition():
+        if save and self.pk is None:
+            self.save()
+
+        open_transition_id, last_transition_time, state_id = self._lock()
+
+        if open_transition_id is not None:
             raise STSError('Cannot start transition while already in one.')
 
         event = Event.get(event)
+
+        graph = graphs.get_graph(self)
+        if graph is not None:
+            self._check_transition(graph, state_id, event and event.pk)
+
         # No end state, therefore this state will marked as in transition
         # until the transition is finished.
-        state = State.TRANSITION
+        state = State.transition_state(self._state.db)
 
         if start_time is None:
             start_time = timezone.now()
@@ -215,9 +995,12 @@ class System(models.Model):
 
         if save:
             transition.save()
+            self._update_snapshot(transition,
+                last_transition_time=last_transition_time)
 
         return transition
 
+    @signals.sends_signals
     @transaction.commit_on_success
     def end_transition(self, state, end_time=None, message=None,
             failed=False, save=True):
@@ -228,16 +1011,31 @@ class System(models.Model):
         transition that had been started with `start_transition`.
         """
 
-        if not self.in_transition():
+        # Locks the open transition itself, concurrent calls wait here and
+        # then find it ended.
+        try:
+            transition = Transition.objects.select_for_update()\
+                .get(system=self.pk,
+                    state=State.transition_state(self._state.db))
+        except Transition.DoesNotExist:
             raise STSError('Cannot end a transition while not in one.')
 
         state = State.get(state)
 
+        graph = graphs.get_graph(self)
+        if graph is not None and not failed:
+            # The snapshot holds the open transition, so the state it was
+            # started from is that of the transition before it
+            state_ids = self.transitions.exclude(pk=transition.pk)\
+                .filter(start_time__lte=transition.start_time)\
+                .order_by('-start_time', '-id')\
+                .values_list('state', flat=True)[:1]
+            self._check_transition(graph, state_ids[0] if state_ids else None,
+                transition.event_id, state.pk)
+
         if end_time is None:
             end_time = timezone.now()
 
-        transition = self.transitions.get(state=State.TRANSITION)
-
         transition.duration = get_duration(transition.start_time, end_time)
         transition.state = state
         transition.failed = failed
@@ -247,9 +1045,11 @@ class System(models.Model):
 
         if save:
             transition.save()
+            self._update_snapshot(transition, created=False)
 
         return transition
 
+    @signals.sends_signals
     @transaction.commit_on_success
     def transition(self, state, event=None, start_time=None, end_time=None,
             message=None, failed=False, save=True):
@@ -258,7 +1058,12 @@ class System(models.Model):
         since this does not involve long-running transitions.
         """
 
-        if self.in_transition():
+        if save and self.pk is None:
+            self.save()
+
+        open_transition_id, last_transition_time, state_id = self._lock()
+
+        if open_transition_id is not None:
             raise STSError('Cannot start transition while already in one.')
 
         event = Event.get(event)
@@ -266,9 +1071,15 @@ class System(models.Model):
 
         # No end state, therefore this state will marked as in transition
         # until the transition is finished.
-        if state is None or state == State.TRANSITION:
+        if state is None or state == State.transition_state(self._state.db):
             raise STSError('Cannot create a transition with an empty state.')
 
+        # Failures can always be recorded
+        graph = graphs.get_graph(self)
+        if graph is not None and not failed:
+            self._check_transition(graph, state_id, event and event.pk,
+                state.pk)
+
         now = timezone.now()
 
         if start_time is None:
@@ -285,9 +1096,150 @@ class System(models.Model):
 
         if save:
             transition.save()
+            self._update_snapshot(transition,
+                last_transition_time=last_transition_time)
 
         return transition
 
+    def atransition(self, *args, **kwargs):
+        "Returns a future of `transition` for use in coroutines."
+        return aio.run(self.transition, *args, **kwargs)
+
+    def astart_transition(self, *args, **kwargs):
+        "Returns a future of `start_transition` for use in coroutines."
+        return aio.run(self.start_transition, *args, **kwargs)
+
+    def aend_transition(self, *args, **kwargs):
+        "Returns a future of `end_transition` for use in coroutines."
+        return aio.run(self.end_transition, *args, **kwargs)
+
+
+class TransitionManager(models.Manager):
+    def _filter(self, system=None, state=None, event=None,
+            content_type=None, since=None, until=None):
+
+        queryset = self.get_query_set()
+
+        if content_type is not None:
+            queryset = queryset.filter(system__content_type=content_type)
+
+        if system is not None:
+            if isinstance(system, System):
+                queryset = queryset.filter(system=system)
+            elif isinstance(system, basestring):
+                queryset = queryset.filter(system__name=system)
+            else:
+                ct = ContentType.objects.get_for_model(system.__class__)
+                queryset = queryset.filter(system__content_type=ct,
+                    system__object_id=system.pk)
+
+        for field, value in (('state', state), ('event', event)):
+            if isinstance(value, basestring):
+                queryset = queryset.filter(**{field + '__name': value})
+            elif value is not None:
+                queryset = queryset.filter(**{field: value})
+
+        if since is not None:
+            queryset = queryset.filter(start_time__gte=since)
+        if until is not None:
+            queryset = queryset.filter(start_time__lt=until)
+
+        return queryset
+
+    def stats(self, system=None, state=None, event=None, content_type=None,
+            since=None, until=None, bucket=None, percentiles=(50, 90, 99),
+            use_rollups=False):
+
+        """Returns aggregate statistics of the transitions computed by the
+        database.
+
+        The transitions can be filtered by system (anything `System.get`
+        accepts), state and event (instances or names), the content type of
+        the system and start time (since inclusive, until exclusive). The
+        result is a dict of `count`, `failures`, `failure_rate` and the `min`,
+        `avg` and `max` duration in milliseconds along with the requested
+        `percentiles`.
+
+        A percentile p is the duration at index round(p / 100 * (n - 1)) of
+        the n sorted durations, e.g. the 50th percentile of 100, 200, 300 and
+        400 is 300. Each one is read with its own `ORDER BY duration OFFSET`
+        query and the duration is not indexed, so every percentile sorts the
+        matching transitions.
+
+        If `bucket` is one of 'minute', 'hour', 'day', 'month' or 'year', a
+        list of these dicts (without percentiles) is returned instead, one
+        per bucket with a `bucket` key holding the start of the bucket.
+
+        If `use_rollups` is True, the statistics are read from the rollups
+        (see `sts.rollups`) instead. Rollups exclude open transitions and
+        transitions written before they were enabled unless backfilled, and
+        estimate the percentiles. A ValueError is raised if they cannot
+        answer the query, i.e. a system is given, the bucket is 'minute' or
+        the window is not aligned to the rollups.
+        """
+        if use_rollups:
+            if system is not None or bucket == 'minute' or \
+                    not rollups.covers(since, until, self.db):
+                raise ValueError('The rollups cannot answer this query.')
+
+            return rollups.stats(state=state, event=event,
+                content_type=content_type, since=since, until=until,
+                bucket=bucket, percentiles=percentiles, using=self.db)
+
+        queryset = self._filter(system=system, state=state, event=event,
+            content_type=content_type, since=since, until=until)
+
+        aggregates = {
+            'count': models.Count('id'),
+            'durations': models.Count('duration'),
+            'min': models.Min('duration'),
+            'avg': models.Avg('duration'),
+            'max': models.Max('duration'),
+        }
+
+        if bucket is not None:
+            return self._bucket_stats(queryset, bucket, aggregates)
+
+        data = queryset.aggregate(**aggregates)
+        data['failures'] = queryset.filter(failed=True).count()
+        data['failure_rate'] = data['count'] and \
+            float(data['failures']) / data['count']
+
+        durations = queryset.filter(duration__isnull=False)\
+            .order_by('duration').values_list('duration', flat=True)
+
+        data['percentiles'] = {}
+        for percentile in percentiles:
+            if not data['durations']:
+                data['percentiles'][percentile] = None
+                continue
+            # Rounded linear index, not the nearest rank
+            index = int(round(percentile / 100.0 * (data['durations'] - 1)))
+            data['percentiles'][percentile] = durations[index]
+
+        return data
+
+    def _bucket_stats(self, queryset, bucket, aggregates):
+        connection = connections[queryset.db]
+        qn = connection.ops.quote_name
+        column = '{0}.{1}'.format(qn(self.model._meta.db_table),
+            qn('start_time'))
+
+        queryset = queryset.extra(select={
+            'bucket': trunc_sql(connection, bucket, column)
+        }).values('bucket').order_by('bucket')
+
+        failures = dict((row['bucket'], row['failures']) for row in
+            queryset.filter(failed=True).annotate(failures=models.Count('id')))
+
+        data = []
+        for row in queryset.annotate(**aggregates):
+            row['failures'] = failures.get(row['bucket'], 0)
+            row['failure_rate'] = float(row['failures']) / row['count']
+            row['bucket'] = parse_bucket(row['bucket'])
+            data.append(row)
+        return data
+
 
 class Transition(models.Model):
     # The system this transition applies to
@@ -314,9 +1266,16 @@ class Transition(models.Model):
     duration = models.PositiveIntegerField('duration in milliseconds',
         null=True, blank=True)
 
+    objects = TransitionManager()
+
     class Meta(object):
         ordering = ('start_time',)
 
+        # Supports the per-system history and open transition lookups. On
+        # older versions of Django these are only created by the migrations.
+        if django.VERSION >= (1, 5):
+            index_together = (('system', 'start_time'), ('system', 'state'))
+
     def __unicode__(self):
         if self.event_id:
             text = '{0} => {1}'.format(self.event, self.state)
@@ -329,7 +1288,7 @@ class Transition(models.Model):
         return text
 
     def in_transition(self):
-        return self.state_id == State.TRANSITION.pk
+        return self.state_id == State.transition_state(self._state.db).pk
 
     @property
     def current_duration(self):
@@ -344,8 +1303,65 @@ class Transition(models.Model):
         return get_natural_duration(self.start_time, self.end_time)
 
 
+class Rollup(models.Model):
+    "Metrics of ended transitions aggregated over an hour or day."
+    bucket = models.CharField(max_length=10)
+    start_time = models.DateTimeField()
+
+    state = models.ForeignKey(State, related_name='+')
+    event = models.ForeignKey(Event, null=True, blank=True, related_name='+')
+    content_type = models.ForeignKey(ContentType, null=True, blank=True,
+        related_name='+')
+
+    count = models.PositiveIntegerField(default=0)
+    failures = models.PositiveIntegerField(default=0)
+
+    # Durations in milliseconds
+    duration_count = models.PositiveIntegerField(default=0)
+    duration_sum = models.BigIntegerField(default=0)
+    duration_min = models.PositiveIntegerField(null=True, blank=True)
+    duration_max = models.PositiveIntegerField(null=True, blank=True)
+
+    # Comma-separated counts of the power of two duration buckets
+    histogram = models.TextField(blank=True)
+
+    class Meta(object):
+        ordering = ('start_time',)
+        unique_together = (('bucket', 'start_time', 'state', 'event',
+            'content_type'),)
+
+    def __unicode__(self):
+        return u'{0} @ {1} ({2})'.format(self.state_id, self.start_time,
+            self.bucket)
+
+    def get_summary(self):
+        summary = rollups.empty()
+        for key in ('count', 'failures', 'duration_count', 'duration_sum',
+                'duration_min', 'duration_max'):
+            summary[key] = getattr(self, key)
+        if self.histogram:
+            summary['histogram'] = [int(x) for x in self.histogram.split(',')]
+        return summary
+
+    def set_summary(self, summary):
+        for key in ('count', 'failures', 'duration_count', 'duration_sum',
+                'duration_min', 'duration_max'):
+            setattr(self, key, summary[key])
+        self.histogram = ','.join(str(x) for x in summary['histogram'])
+
+
+State.cache = NameCache(State)
+Event.cache = NameCache(Event)
+
+
 class STSModel(models.Model):
-    "Augments model for basic object state transitions."
+    """Augments model for basic object state transitions.
+
+    The system is fetched along with its current state on first use and
+    kept on the instance. Its snapshot is updated by the transition methods,
+    so reading the state afterwards does not query the database. Pass
+    `refresh=True` to reload a snapshot changed elsewhere.
+    """
 
     @property
     def system(self):
@@ -353,25 +1369,37 @@ class STSModel(models.Model):
             self._sts = System.get(self)
         return self._sts
 
-    def current_state(self, *args, **kwargs):
+    def current_state(self, refresh=False):
         "Returns the current state."
-        self.system.current_state(*args, **kwargs)
+        return self.system.current_state(refresh=refresh)
 
-    def in_transition(self, *args, **kwargs):
+    def in_transition(self, refresh=False):
         "Returns whether the object is current in transition."
-        self.system.in_transition(*args, **kwargs)
+        return self.system.in_transition(refresh=refresh)
+
+    def failed_last_transition(self, refresh=False):
+        "Returns whether the last transition failed."
+        return self.system.failed_last_transition(refresh=refresh)
+
+    def allowed_events(self, refresh=False):
+        "Returns the events allowed in the current state."
+        return self.system.allowed_events(refresh=refresh)
 
     def transition(self, *args, **kwargs):
         "Creates an immediate state transition."
-        self.system.transition(*args, **kwargs)
+        return self.system.transition(*args, **kwargs)
 
     def start_transition(self, *args, **kwargs):
         "Starts a state transition given some event."
-        self.system.start_transition(*args, **kwargs)
+        return self.system.start_transition(*args, **kwargs)
 
     def end_transition(self, *args, **kwargs):
         "Ends a state transition with some state."
-        self.system.end_transition(*args, **kwargs)
+        return self.system.end_transition(*args, **kwargs)
 
     class Meta(object):
         abstract = True
+
+
+# Connect the sinks configured by STS_SINKS
+get_sinks()
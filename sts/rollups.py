@@ -0,0 +1,358 @@
+"""Incrementally maintained rollups of transition metrics.
+
+Each `Rollup` row summarizes the ended transitions of one state, event and
+content type (of the system) whose start time falls in an hour (or a day once
+compacted). Rollups are maintained as transitions end when `STS_ROLLUPS` is
+True and can be rebuilt with the `sts_rollup` management command.
+
+Durations are summarized in a histogram of power of two buckets so rollups
+can be merged and percentiles estimated without the raw rows.
+"""
+import logging
+from django.conf import settings
+from django.db import transaction, IntegrityError
+
+# Bucket 0 holds zero durations, bucket i holds [2 ** (i - 1), 2 ** i)
+HISTOGRAM_SIZE = 33
+
+HOUR = 'hour'
+DAY = 'day'
+
+logger = logging.getLogger(__name__)
+
+
+def enabled():
+    return getattr(settings, 'STS_ROLLUPS', False)
+
+
+def truncate(dt, bucket):
+    "Returns the start of the bucket `dt` falls in."
+    dt = dt.replace(minute=0, second=0, microsecond=0)
+    if bucket == DAY:
+        dt = dt.replace(hour=0)
+    return dt
+
+
+def histogram_index(duration):
+    if duration <= 0:
+        return 0
+    return min(len(bin(duration)) - 2, HISTOGRAM_SIZE - 1)
+
+
+def empty():
+    "Returns an empty summary."
+    return {
+        'count': 0,
+        'failures': 0,
+        'duration_count': 0,
+        'duration_sum': 0,
+        'duration_min': None,
+        'duration_max': None,
+        'histogram': [0] * HISTOGRAM_SIZE,
+    }
+
+
+def add(summary, duration, failed):
+    "Adds a single transition to a summary."
+    summary['count'] += 1
+    if failed:
+        summary['failures'] += 1
+    if duration is not None:
+        summary['duration_count'] += 1
+        summary['duration_sum'] += duration
+        if summary['duration_min'] is None or duration < summary['duration_min']:
+            summary['duration_min'] = duration
+        if summary['duration_max'] is None or duration > summary['duration_max']:
+            summary['duration_max'] = duration
+        summary['histogram'][histogram_index(duration)] += 1
+    return summary
+
+
+def merge(summary, other):
+    "Merges `other` into `summary`."
+    for key in ('count', 'failures', 'duration_count', 'duration_sum'):
+        summary[key] += other[key]
+    for key, func in (('duration_min', min), ('duration_max', max)):
+        values = [v for v in (summary[key], other[key]) if v is not None]
+        summary[key] = func(values) if values else None
+    summary['histogram'] = [a + b for a, b in
+        zip(summary['histogram'], other['histogram'])]
+    return summary
+
+
+def percentile(summary, percentile):
+    """Estimates a percentile from the histogram. The upper bound of the
+    bucket holding the rank `Transition.objects.stats` uses is returned,
+    capped by the maximum.
+    """
+    if not summary['duration_count']:
+        return
+    rank = int(round(percentile / 100.0 * (summary['duration_count'] - 1)))
+    seen = 0
+    for index, count in enumerate(summary['histogram']):
+        seen += count
+        if seen > rank:
+            upper = 0 if index == 0 else 2 ** index - 1
+            return min(upper, summary['duration_max'])
+
+
+def _sort_key(item):
+    # Consistent order for locking rows, ids may be None
+    return tuple(-1 if value is None else value for value in item[0])
+
+
+def _save(key, summary, using=None):
+    """Merges `summary` into the rollup row for `key`, creating it if needed.
+
+    The unique constraint does not apply to rows with a NULL event or
+    content type, so concurrent writers may both create the row. Such
+    duplicates are merged into the first row here.
+    """
+    from .models import Rollup
+
+    queryset = Rollup.objects.db_manager(using).select_for_update()\
+        .filter(**key).order_by('pk')
+
+    rows = list(queryset)
+
+    if not rows:
+        rollup = Rollup(**key)
+        rollup.set_summary(summary)
+
+        sid = transaction.savepoint(using=using)
+        try:
+            rollup.save(using=using, force_insert=True)
+        except IntegrityError:
+            # Created concurrently, update it instead
+            transaction.savepoint_rollback(sid, using=using)
+            rows = list(queryset)
+        else:
+            transaction.savepoint_commit(sid, using=using)
+            return
+
+    rollup = rows[0]
+    merged = rollup.get_summary()
+
+    for duplicate in rows[1:]:
+        merge(merged, duplicate.get_summary())
+        duplicate.delete()
+
+    rollup.set_summary(merge(merged, summary))
+    rollup.save(using=using)
+
+
+def record(transitions, using=None):
+    """Adds ended transitions to their hourly rollups. Transitions are grouped
+    first so each rollup row is written once.
+
+    Rollups must not fail the transitions being written, so errors are
+    rolled back to a savepoint and logged. The affected rollups can be
+    rebuilt with `backfill`.
+    """
+    summaries = {}
+
+    for trans in transitions:
+        key = (truncate(trans.start_time, HOUR), trans.state_id,
+            trans.event_id, trans.system.content_type_id)
+        add(summaries.setdefault(key, empty()), trans.duration, trans.failed)
+
+    sid = transaction.savepoint(using=using)
+
+    try:
+        for (start_time, state_id, event_id, content_type_id), summary in \
+                sorted(summaries.items(), key=_sort_key):
+            _save({
+                'bucket': HOUR,
+                'start_time': start_time,
+                'state_id': state_id,
+                'event_id': event_id,
+                'content_type_id': content_type_id,
+            }, summary, using=using)
+    except Exception:
+        transaction.savepoint_rollback(sid, using=using)
+        logger.exception('Failed to record the rollups of {0} transitions, '
+            'rebuild them with the sts_rollup command'.format(
+                len(transitions)))
+    else:
+        transaction.savepoint_commit(sid, using=using)
+
+
+def backfill(since=None, until=None, using=None, progress=None):
+    """Rebuilds the hourly rollups for transitions started in the window.
+
+    `since` and `until` are truncated to the hour. Existing rollups in the
+    window are replaced. `progress` is called with the number of transitions
+    read so far every 10000 transitions. Returns the number of transitions
+    read.
+    """
+    from .models import Rollup, State, Transition
+
+    # Open transitions are added once they end
+    transitions = Transition.objects.db_manager(using)\
+        .exclude(state=State.transition_state(using))
+    rollups = Rollup.objects.db_manager(using).filter(bucket=HOUR)
+
+    if since is not None:
+        since = truncate(since, HOUR)
+        transitions = transitions.filter(start_time__gte=since)
+        rollups = rollups.filter(start_time__gte=since)
+    if until is not None:
+        until = truncate(until, HOUR)
+        transitions = transitions.filter(start_time__lt=until)
+        rollups = rollups.filter(start_time__lt=until)
+
+    rows = transitions.order_by().values_list('start_time', 'state',
+        'event', 'system__content_type', 'duration', 'failed')
+
+    summaries = {}
+    read = 0
+
+    for start_time, state_id, event_id, content_type_id, duration, \
+            failed in rows.iterator():
+        key = (truncate(start_time, HOUR), state_id, event_id, content_type_id)
+        add(summaries.setdefault(key, empty()), duration, failed)
+        read += 1
+        if progress and not read % 10000:
+            progress(read)
+
+    with transaction.commit_on_success(using=using):
+        rollups.delete()
+
+        objs = []
+        for (start_time, state_id, event_id, content_type_id), summary in \
+                summaries.items():
+            rollup = Rollup(bucket=HOUR, start_time=start_time,
+                state_id=state_id, event_id=event_id,
+                content_type_id=content_type_id)
+            rollup.set_summary(summary)
+            objs.append(rollup)
+
+        Rollup.objects.db_manager(using).bulk_create(objs)
+
+    return read
+
+
+def compact(before, using=None):
+    """Merges the hourly rollups before `before` (truncated to the day) into
+    daily rollups. Returns the number of hourly rollups merged.
+    """
+    from .models import Rollup
+
+    before = truncate(before, DAY)
+    manager = Rollup.objects.db_manager(using)
+
+    with transaction.commit_on_success(using=using):
+        hourly = manager.select_for_update()\
+            .filter(bucket=HOUR, start_time__lt=before)
+
+        summaries = {}
+        count = 0
+
+        for rollup in hourly.iterator():
+            key = (truncate(rollup.start_time, DAY), rollup.state_id,
+                rollup.event_id, rollup.content_type_id)
+            merge(summaries.setdefault(key, empty()), rollup.get_summary())
+            count += 1
+
+        for (start_time, state_id, event_id, content_type_id), summary in \
+                sorted(summaries.items(), key=_sort_key):
+            _save({
+                'bucket': DAY,
+                'start_time': start_time,
+                'state_id': state_id,
+                'event_id': event_id,
+                'content_type_id': content_type_id,
+            }, summary, using=using)
+
+        hourly.delete()
+
+    return count
+
+
+def covers(since=None, until=None, using=None):
+    """Returns True if the rollups can answer a query for the window without
+    splitting a rollup, i.e. the bounds are aligned to the rollups they fall
+    in.
+    """
+    from .models import Rollup
+
+    for value in (since, until):
+        if value is None:
+            continue
+        if value != truncate(value, HOUR):
+            return False
+        if value != truncate(value, DAY) and Rollup.objects.db_manager(using)\
+                .filter(bucket=DAY, start_time=truncate(value, DAY)).exists():
+            return False
+    return True
+
+
+def stats(state=None, event=None, content_type=None, since=None, until=None,
+        bucket=None, percentiles=(50, 90, 99), using=None):
+
+    """Returns the same statistics as `Transition.objects.stats` computed
+    from the rollups. Percentiles are estimated from the histograms. Only
+    ended transitions are included.
+    """
+    from .models import Rollup
+
+    rollups = Rollup.objects.db_manager(using).all()
+
+    for field, value in (('state', state), ('event', event)):
+        if isinstance(value, basestring):
+            rollups = rollups.filter(**{field + '__name': value})
+        elif value is not None:
+            rollups = rollups.filter(**{field: value})
+
+    if content_type is not None:
+        rollups = rollups.filter(content_type=content_type)
+    if since is not None:
+        rollups = rollups.filter(start_time__gte=since)
+    if until is not None:
+        rollups = rollups.filter(start_time__lt=until)
+
+    if bucket is not None and bucket not in (HOUR, DAY, 'month', 'year'):
+        raise ValueError('Rollups cannot be bucketed by {0}.'.format(bucket))
+
+    summaries = {}
+
+    for rollup in rollups.order_by('start_time').iterator():
+        if bucket is None:
+            key = None
+        elif bucket == DAY or bucket == HOUR and rollup.bucket == DAY:
+            # Compacted rollups are reported in their daily bucket
+            key = truncate(rollup.start_time, DAY)
+        elif bucket == HOUR:
+            key = rollup.start_time
+        else:
+            key = truncate(rollup.start_time, DAY).replace(day=1)
+            if bucket == 'year':
+                key = key.replace(month=1)
+        merge(summaries.setdefault(key, empty()), rollup.get_summary())
+
+    def format(summary):
+        return {
+            'count': summary['count'],
+            'durations': summary['duration_count'],
+            'failures': summary['failures'],
+            'failure_rate': summary['count'] and
+                float(summary['failures']) / summary['count'],
+            'min': summary['duration_min'],
+            'max': summary['duration_max'],
+            'avg': float(summary['duration_sum']) / summary['duration_count']
+                if summary['duration_count'] else None,
+        }
+
+    if bucket is None:
+        summary = summaries.get(None, empty())
+        data = format(summary)
+        data['percentiles'] = dict((p, percentile(summary, p))
+            for p in percentiles)
+        return data
+
+    data = []
+    for key in sorted(summaries):
+        row = format(summaries[key])
+        row['bucket'] = key
+        data.append(row)
+    return data
@@ -12,3 +12,28 @@ def end_transition(obj, *args, **kwargs):
     "Ends a state transition with some state."
     from .models import System
     return System.get(obj).end_transition(*args, **kwargs)
+
+def with_sts_state(objs, create=False):
+    """Attaches the System of each model object along with its current state.
+
+    The systems are resolved with `System.get_many` and the current states
+    with a single query, so the cost is constant regardless of the number of
+    objects. The objects are returned as a list and the `current_state()`,
+    `in_transition()` and `failed_last_transition()` methods of `STSModel`
+    subclasses (or of `obj.system` with `refresh=False`) no longer query
+    the database. Objects without a System get an unsaved one unless
+    `create` is True.
+    """
+    from .models import System, State
+    objs = list(objs)
+    systems = System.get_many(objs, create=create)
+
+    states = State.objects.in_bulk(set(system.last_state_id
+        for system in systems if system.last_state_id))
+
+    for obj, system in zip(objs, systems):
+        if system.last_state_id:
+            system.last_state = states[system.last_state_id]
+        obj._sts = system
+
+    return objs
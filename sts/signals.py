@@ -0,0 +1,81 @@
+"""Signals sent when transitions start, end or fail.
+
+Each signal is sent with the `System` class as the sender and the `system`
+and `transition` as arguments. `transition_failed` is sent in addition to
+`transition_ended` for failed transitions.
+
+The signals are sent once the transition method (including the bulk methods
+and buffered writes) has returned, i.e. after its transaction is committed.
+When called within a transaction managed by the caller they are sent before
+that transaction is committed. Exceptions raised by receivers are logged
+rather than propagated since the transitions are already written. Transitions
+written with `bulk_create` may not have a primary key.
+"""
+import logging
+import threading
+from functools import wraps
+from django.dispatch import Signal
+
+transition_started = Signal(providing_args=['system', 'transition'])
+transition_ended = Signal(providing_args=['system', 'transition'])
+transition_failed = Signal(providing_args=['system', 'transition'])
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def queue(transitions):
+    "Queues the signals of written transitions until the outermost call ends."
+    pending = getattr(_local, 'pending', None)
+
+    for transition in transitions:
+        if transition.in_transition():
+            signals = [transition_started]
+        elif transition.failed:
+            signals = [transition_ended, transition_failed]
+        else:
+            signals = [transition_ended]
+
+        for signal in signals:
+            # Outside of a decorated call, send right away
+            if pending is None:
+                _send(signal, transition)
+            else:
+                pending.append((signal, transition))
+
+
+def _send(signal, transition):
+    from .models import System
+
+    for receiver, response in signal.send_robust(sender=System,
+            system=transition.system, transition=transition):
+        if isinstance(response, Exception):
+            logger.error('Error in {0!r} receiving a transition '
+                'signal: {1!r}'.format(receiver, response))
+
+
+def sends_signals(func):
+    """Sends the signals queued during the call once it returns. The
+    signals are discarded if it raises.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'pending', None) is not None:
+            return func(*args, **kwargs)
+
+        _local.pending = pending = []
+
+        # Cleared on any exit, including KeyboardInterrupt or SystemExit,
+        # so later calls in this thread are not left queueing forever
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            _local.pending = None
+
+        for signal, transition in pending:
+            _send(signal, transition)
+
+        return result
+    return wrapper
@@ -0,0 +1,291 @@
+"""Sinks forwarding the transition signals to consumers in batches.
+
+A sink receives the `transition_started`, `transition_ended` and
+`transition_failed` signals once connected, serializes them into records and
+writes them in batches from a background thread, so consumers can subscribe
+to transitions rather than polling the views. Sinks listed in the
+`STS_SINKS` setting are connected on startup:
+
+    STS_SINKS = [
+        {'class': 'sts.sinks.LogSink', 'path': '/var/log/sts.ndjson'},
+        {'class': 'sts.sinks.SocketSink', 'path': '/var/run/sts.sock'},
+    ]
+
+The remaining keys are passed to the sink class.
+"""
+import json
+import time
+import atexit
+import socket
+import logging
+import threading
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.importlib import import_module
+from .signals import transition_started, transition_ended, transition_failed
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+logger = logging.getLogger(__name__)
+
+SIGNALS = (
+    ('started', transition_started),
+    ('ended', transition_ended),
+    ('failed', transition_failed),
+)
+
+
+def serialize(name, system, transition):
+    "Returns the record of a signal."
+    return {
+        'signal': name,
+        'system': system.pk,
+        'content_type': system.content_type_id,
+        'object_id': system.object_id,
+        'name': system.name,
+        'transition': transition.pk,
+        'state': transition.state.name,
+        'event': transition.event_id and transition.event.name or None,
+        'message': transition.message,
+        'failed': transition.failed,
+        'start_time': transition.start_time,
+        'end_time': transition.end_time,
+        'duration': transition.duration,
+    }
+
+
+class Sink(object):
+    """Base class of sinks, subclasses implement `write`.
+
+    A batch is written once `batch_size` records are queued or `interval`
+    seconds have passed since the first one was. Records are dropped (and
+    counted) rather than blocking the sender when `max_size` records are
+    queued. If `threaded` is False, no thread is started and records are
+    only written by calling `flush`.
+    """
+    def __init__(self, batch_size=100, interval=1.0, max_size=10000,
+            threaded=True):
+
+        self.batch_size = batch_size
+        self.interval = interval
+        self.threaded = threaded
+
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self._queue = queue.Queue(max_size)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._receivers = []
+
+        atexit.register(self.close)
+
+    def write(self, records):
+        "Writes a batch of records."
+        raise NotImplementedError
+
+    def connect(self):
+        "Connects the sink to the transition signals."
+        for name, signal in SIGNALS:
+            def receiver(sender, system, transition, name=name, **kwargs):
+                self.receive(name, system, transition)
+            self._receivers.append((signal, receiver))
+            signal.connect(receiver, weak=False)
+
+    def disconnect(self):
+        for signal, receiver in self._receivers:
+            signal.disconnect(receiver)
+        self._receivers = []
+
+    def _start(self):
+        with self._lock:
+            if self.threaded and self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name='sts-sink')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def receive(self, name, system, transition):
+        "Queues the record of a signal without blocking."
+        if self._stopped.is_set():
+            return
+
+        self._start()
+
+        try:
+            self._queue.put_nowait(serialize(name, system, transition))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+        else:
+            with self._lock:
+                self.received += 1
+
+    def _drain(self):
+        "Gets up to `batch_size` records waiting at most `interval` seconds."
+        records = []
+        deadline = None
+
+        while len(records) < self.batch_size:
+            if deadline is None:
+                timeout = self.interval
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+            try:
+                records.append(self._queue.get(True, timeout))
+            except queue.Empty:
+                break
+            if deadline is None:
+                deadline = time.time() + self.interval
+
+        return records
+
+    def _run(self):
+        while not self._stopped.is_set() or not self._queue.empty():
+            records = self._drain()
+            if records:
+                self._write(records)
+
+    def _write(self, records):
+        try:
+            self.write(records)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            logger.exception('Failed to write {0} transition '
+                'records'.format(len(records)))
+        else:
+            with self._lock:
+                self.written += len(records)
+
+    def flush(self):
+        "Writes all currently queued records in the calling thread."
+        while True:
+            records = []
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not records:
+                break
+            self._write(records)
+
+    def close(self, timeout=None):
+        "Disconnects the sink and waits for the queue to drain."
+        self.disconnect()
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        "Returns a dict of counters suitable for exposing as metrics."
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'received': self.received,
+                'written': self.written,
+                'dropped': self.dropped,
+                'errors': self.errors,
+            }
+
+
+class QueueSink(Sink):
+    """Puts each batch (a list of records) on the in-process `batches` queue
+    for consumers to `get`. Batches are dropped when `max_batches` are
+    waiting.
+    """
+    def __init__(self, max_batches=1000, **kwargs):
+        self.batches = queue.Queue(max_batches)
+        super(QueueSink, self).__init__(**kwargs)
+
+    def write(self, records):
+        try:
+            self.batches.put_nowait(records)
+        except queue.Full:
+            with self._lock:
+                self.dropped += len(records)
+
+    def get(self, block=True, timeout=None):
+        "Returns the next batch, raises `Queue.Empty` when there is none."
+        return self.batches.get(block, timeout)
+
+
+def _ndjson(records):
+    return ''.join(json.dumps(record, cls=DjangoJSONEncoder) + '\n'
+        for record in records)
+
+
+class LogSink(Sink):
+    "Appends the records to the file at `path` as newline-delimited JSON."
+    def __init__(self, path, **kwargs):
+        self.path = path
+        super(LogSink, self).__init__(**kwargs)
+
+    def write(self, records):
+        # Reopened per batch so rotated files are picked up
+        with open(self.path, 'a') as out:
+            out.write(_ndjson(records))
+
+
+class SocketSink(Sink):
+    """Sends the records as newline-delimited JSON to the Unix domain socket
+    at `path`. The connection is reestablished on the next batch after an
+    error, the batch that failed is dropped.
+    """
+    def __init__(self, path, timeout=5.0, **kwargs):
+        self.path = path
+        self.timeout = timeout
+        self._socket = None
+        super(SocketSink, self).__init__(**kwargs)
+
+    def write(self, records):
+        if self._socket is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self._socket = sock
+
+        try:
+            self._socket.sendall(_ndjson(records).encode('utf-8'))
+        except socket.error:
+            self._socket.close()
+            self._socket = None
+            raise
+
+    def close(self, timeout=None):
+        super(SocketSink, self).close(timeout)
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+_sinks = None
+_sinks_lock = threading.Lock()
+
+
+def get_sinks():
+    """Returns the sinks configured by the `STS_SINKS` setting, created and
+    connected on first use.
+    """
+    global _sinks
+    with _sinks_lock:
+        if _sinks is None:
+            _sinks = []
+            for options in getattr(settings, 'STS_SINKS', ()):
+                options = dict(options)
+                module, name = options.pop('class').rsplit('.', 1)
+                sink = getattr(import_module(module), name)(**options)
+                sink.connect()
+                _sinks.append(sink)
+        return _sinks
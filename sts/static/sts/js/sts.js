@@ -159,13 +159,36 @@
             if (this.options.poll) this.startPolling({reset: true});
         },
 
+        // The systems are paginated, `next` is the cursor of the next page
+        parse: function(resp, options) {
+            this.next = resp.next;
+            return resp.results;
+        },
+
+        // Fetches the first page with `options` and merges the following
+        // pages into the collection
+        fetchAll: function(options) {
+            var _this = this;
+
+            var fetchNext = function() {
+                if (!_this.next) return;
+                _this.fetch({
+                    remove: false,
+                    data: {cursor: _this.next},
+                    success: fetchNext
+                });
+            };
+
+            return this.fetch(_.extend({}, options, {success: fetchNext}));
+        },
+
         startPolling: function(options) {
             this.stopPolling();
-            this.fetch(options);
+            this.fetchAll(options);
 
             var _this = this;
             this._pollInterval = setInterval(function() {
-                _this.fetch();
+                _this.fetchAll({remove: false});
             }, this.options.interval);
         },
 
@@ -1,6 +1,9 @@
 import re
 import sys
+from django.conf import settings
+from django.db import connections
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.timesince import timesince
 
 def total_seconds(td):
@@ -20,6 +23,16 @@ short_units = {
     'y': re.compile(' ?years?'),
 }
 
+# Seconds, names and short name of the units `timesince` reports in
+duration_units = (
+    (60 * 60 * 24 * 365, 'year', 'years', 'y'),
+    (60 * 60 * 24 * 30, 'month', 'months', 'mth'),
+    (60 * 60 * 24 * 7, 'week', 'weeks', 'wk'),
+    (60 * 60 * 24, 'day', 'days', 'd'),
+    (60 * 60, 'hour', 'hours', 'h'),
+    (60, 'minute', 'minutes', 'm'),
+)
+
 
 class classproperty(object):
     def __init__(self, getter):
@@ -29,6 +42,16 @@ class classproperty(object):
         return self.getter(owner)
 
 
+def is_committed(using):
+    """Returns False if the connection is in a transaction which may hold
+    uncommitted writes. Rows read from then on may still be rolled back, so
+    they must not be cached beyond it. Django marks managed transactions
+    dirty on any query, so call this before reading.
+    """
+    connection = connections[using]
+    return not (connection.is_managed() and connection.is_dirty())
+
+
 def get_duration(start_time, end_time=None):
     "Returns the duration in milliseconds between two times."
     if end_time is None:
@@ -36,11 +59,56 @@ def get_duration(start_time, end_time=None):
     return int(round(total_seconds(end_time - start_time) * 1000))
 
 
-def get_natural_duration(start_time, end_time=None, short=False):
-    "Returns the natural duration down the milliseconds."
+def _format_unit(count, unit, short):
+    seconds, name, plural, abbr = unit
+    if short:
+        return '{0}{1}'.format(count, abbr)
+    return '{0} {1}'.format(count, name if count == 1 else plural)
+
+
+def format_duration(duration, short=False):
+    """Formats a duration in milliseconds the same way as
+    `get_natural_duration` using integer arithmetic only. Unlike `timesince`
+    the unit names are not translated. None, the duration of an open
+    transition, is returned as is since its end is not known.
+    """
+    if duration is None:
+        return
+    if duration < 1000:
+        return '{0} milliseconds'.format(duration)
+    if duration < 60000:
+        return '{0} seconds'.format((duration + 500) // 1000)
+
+    since = duration // 1000
+
+    # At least a minute, so the last unit always matches
+    for i, unit in enumerate(duration_units):
+        count = since // unit[0]
+        if count:
+            break
+
+    text = _format_unit(count, unit, short)
+
+    # Like timesince, only the adjacent smaller unit is included
+    if i + 1 < len(duration_units):
+        next_unit = duration_units[i + 1]
+        count = (since - count * unit[0]) // next_unit[0]
+        if count:
+            text = '{0}, {1}'.format(text, _format_unit(count, next_unit, short))
+
+    return text
+
+
+def get_natural_duration(start_time, end_time=None, short=False, fast=False):
+    """Returns the natural duration down the milliseconds. If `fast` is True
+    the duration is formatted with `format_duration`.
+    """
     if end_time is None:
         end_time = timezone.now()
 
+    if fast:
+        return format_duration(get_duration(start_time, end_time), short)
+
     duration = int(round(total_seconds(end_time - start_time) * 1000))
 
     if duration < 1000:
@@ -55,3 +123,55 @@ def get_natural_duration(start_time, end_time=None, short=False):
     return since
 
 
+
+# Per-vendor formats for truncating datetimes to a bucket
+_trunc_formats = {
+    'sqlite': {
+        'minute': '%Y-%m-%d %H:%M:00',
+        'hour': '%Y-%m-%d %H:00:00',
+        'day': '%Y-%m-%d 00:00:00',
+        'month': '%Y-%m-01 00:00:00',
+        'year': '%Y-01-01 00:00:00',
+    },
+    'mysql': {
+        'minute': '%Y-%m-%d %H:%i:00',
+        'hour': '%Y-%m-%d %H:00:00',
+        'day': '%Y-%m-%d 00:00:00',
+        'month': '%Y-%m-01 00:00:00',
+        'year': '%Y-01-01 00:00:00',
+    },
+}
+
+BUCKETS = ('minute', 'hour', 'day', 'month', 'year')
+
+
+def trunc_sql(connection, bucket, column):
+    """Returns SQL truncating the datetime `column` to the start of its
+    bucket. The SQL is suitable for `QuerySet.extra`.
+    """
+    if bucket not in BUCKETS:
+        raise ValueError('Bucket must be one of {0}.'.format(', '.join(BUCKETS)))
+
+    vendor = connection.vendor
+
+    if vendor == 'postgresql':
+        return "DATE_TRUNC('{0}', {1})".format(bucket, column)
+
+    if vendor not in _trunc_formats:
+        raise ValueError('Buckets are not supported on {0}.'.format(vendor))
+
+    # Escaped for the parameter substitution of `extra`
+    fmt = _trunc_formats[vendor][bucket].replace('%', '%%')
+
+    if vendor == 'sqlite':
+        return "strftime('{0}', {1})".format(fmt, column)
+    return "DATE_FORMAT({0}, '{1}')".format(column, fmt)
+
+
+def parse_bucket(value):
+    "Normalizes a bucket value returned by the database to a datetime."
+    if isinstance(value, basestring):
+        value = parse_datetime(value)
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    return value
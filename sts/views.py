@@ -1,11 +1,24 @@
 import json
-from django.http import HttpResponse
-from django.db.models import Count
+import base64
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseBadRequest
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5 streams iterators passed to HttpResponse
+    StreamingHttpResponse = HttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.core.serializers.json import DjangoJSONEncoder
 from django.core.urlresolvers import reverse
+from django.utils.dateparse import parse_datetime
 from .models import System
-from .utils import get_natural_duration
+from .utils import get_natural_duration, format_duration
+
+
+# Number of transitions serialized per chunk of a streamed response
+STREAM_CHUNK_SIZE = 100
 
 
 def _system(system, include_transitions=True):
@@ -15,8 +28,9 @@ def _system(system, include_transitions=True):
         'created': system.created,
         'modified': system.modified,
         'url': reverse('sts-system-detail', kwargs={'pk': system.pk}),
-        'in_transition': system.in_transition(),
-        'failed_last_transition': system.failed_last_transition(),
+        'in_transition': system.in_transition(refresh=False),
+        'failed_last_transition':
+            system.failed_last_transition(refresh=False),
     }
 
     if system.content_type_id:
@@ -31,20 +45,28 @@ def _system(system, include_transitions=True):
     return data
 
 
-def _transitions(system):
+def _iter_transitions(system):
+    "Yields the transition data of a system in constant memory."
+    fast = getattr(settings, 'STS_FAST_DURATIONS', False)
     last = None
-    data = []
 
-    for trans in system.transitions.select_related('event', 'state'):
+    for trans in system.iter_transitions(related=True):
         # Get the delay from the last transition if one exists
         if last:
-            delay = get_natural_duration(last.end_time, trans.start_time)
+            delay = get_natural_duration(last.end_time, trans.start_time,
+                fast=fast)
         else:
             delay = None
 
         last = trans
+        duration = trans.current_duration
+
+        if fast:
+            natural_duration = format_duration(duration)
+        else:
+            natural_duration = trans.natural_duration
 
-        data.append({
+        yield {
             'id': trans.pk,
             'state': unicode(trans.state),
             'event': trans.event_id and unicode(trans.event) or None,
@@ -52,17 +74,80 @@ def _transitions(system):
             'failed': trans.failed,
             'start_time': trans.start_time,
             'end_time': trans.end_time,
-            'duration': trans.current_duration,
-            'natural_duration': trans.natural_duration,
+            'duration': duration,
+            'natural_duration': natural_duration,
             'delay': delay,
-        })
+        }
 
-    return data
+
+def _transitions(system):
+    return list(_iter_transitions(system))
+
+
+def _stream_ndjson(system, chunk_size):
+    "Yields the transitions as newline-delimited JSON."
+    lines = []
+    for data in _iter_transitions(system):
+        lines.append(json.dumps(data, cls=DjangoJSONEncoder))
+        if len(lines) == chunk_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def _stream_json(system, chunk_size):
+    "Yields the system as a JSON document with the transitions streamed."
+    head = json.dumps(_system(system, include_transitions=False),
+        cls=DjangoJSONEncoder)
+    yield head[:-1] + ', "transitions": ['
+
+    items = []
+    sep = ''
+    for data in _iter_transitions(system):
+        items.append(json.dumps(data, cls=DjangoJSONEncoder))
+        if len(items) == chunk_size:
+            yield sep + ', '.join(items)
+            items = []
+            sep = ', '
+    if items:
+        yield sep + ', '.join(items)
+
+    yield ']}'
+
+
+def _content_objects(systems):
+    "Resolves the generic foreign keys with one query per content type."
+    object_ids = {}
+
+    for system in systems:
+        if system.content_type_id:
+            object_ids.setdefault(system.content_type, set())\
+                .add(system.object_id)
+
+    objects = {}
+
+    for content_type, pks in object_ids.items():
+        model = content_type.model_class()
+        # Stale content type, all of its systems are orphaned
+        if model is None:
+            continue
+        objects[content_type.pk] = model._default_manager.in_bulk(list(pks))
+
+    cache_attr = System.content_object.cache_attr
+
+    for system in systems:
+        if system.content_type_id:
+            setattr(system, cache_attr, objects.get(system.content_type_id,
+                {}).get(system.object_id))
 
 
 def _systems(systems, include_transitions=True):
     data = []
 
+    systems = list(systems)
+    _content_objects(systems)
+
     for system in systems:
         # Ignore orphaned systems
         if system.object_id and not system.content_object:
@@ -72,15 +157,127 @@ def _systems(systems, include_transitions=True):
     return data
 
 
+def _encode_cursor(system):
+    value = u'{0}|{1}'.format(system.modified.isoformat(), system.pk)
+    return base64.urlsafe_b64encode(value.encode('utf-8'))
+
+
+def _decode_cursor(cursor):
+    try:
+        modified, pk = base64.urlsafe_b64decode(cursor.encode('ascii'))\
+            .decode('utf-8').rsplit(u'|', 1)
+        modified = parse_datetime(modified)
+        pk = int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor.')
+    if modified is None:
+        raise ValueError('Invalid cursor.')
+    return modified, pk
+
+
+def _filter_systems(systems, params):
+    "Applies the content_type, state and failed query parameters."
+    content_type = params.get('content_type')
+    if content_type:
+        if content_type.isdigit():
+            systems = systems.filter(content_type=content_type)
+        elif '.' in content_type:
+            app_label, model = content_type.split('.', 1)
+            systems = systems.filter(content_type__app_label=app_label,
+                content_type__model=model)
+        else:
+            raise ValueError('content_type must be an id or "app_label.model".')
+
+    state = params.get('state')
+    if state:
+        systems = systems.filter(last_state__name=state)
+
+    failed = params.get('failed')
+    if failed:
+        if failed.lower() in ('1', 'true'):
+            systems = systems.filter(last_failed=True)
+        elif failed.lower() in ('0', 'false'):
+            systems = systems.exclude(last_failed=True)
+        else:
+            raise ValueError('failed must be true or false.')
+
+    return systems
+
+
+def _page(systems, params):
+    """Returns a page of systems using keyset pagination on (modified, id).
+
+    The `cursor` parameter is the opaque `next` value of the previous page.
+    """
+    page_size = getattr(settings, 'STS_SYSTEMS_PAGE_SIZE', 100)
+    max_page_size = getattr(settings, 'STS_SYSTEMS_MAX_PAGE_SIZE', 1000)
+
+    limit = params.get('limit')
+    if limit:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit must be positive.')
+        limit = min(limit, max_page_size)
+    else:
+        limit = page_size
+
+    systems = _filter_systems(systems, params).order_by('-modified', '-id')
+
+    cursor = params.get('cursor')
+    if cursor:
+        modified, pk = _decode_cursor(cursor)
+        systems = systems.filter(Q(modified__lt=modified) |
+            Q(modified=modified, id__lt=pk))
+
+    # Fetch one extra to determine if there is another page
+    systems = list(systems[:limit + 1])
+    page = systems[:limit]
+
+    return {
+        'results': _systems(page, include_transitions=False),
+        'next': _encode_cursor(page[-1]) if len(systems) > limit else None,
+    }
+
+
+def _stream_format(request):
+    """Returns the format a system's history is streamed in, set by the
+    `stream` parameter or an Accept header of application/x-ndjson.
+    """
+    stream = request.GET.get('stream')
+    if stream is None and 'application/x-ndjson' in \
+            request.META.get('HTTP_ACCEPT', ''):
+        return 'ndjson'
+    return stream
+
+
 def systems(request, pk=None):
-    systems = System.objects.annotate(count=Count('transitions')).filter(count__gt=0)
+    # Streams are served to any client, e.g. exports without the header
+    stream = pk and _stream_format(request)
+
+    if not request.is_ajax() and not stream:
+        return render(request, 'sts/systems.html')
+
+    systems = System.objects.filter(transition_count__gt=0)\
+        .select_related('content_type')
 
     if pk:
-        data = _system(get_object_or_404(systems, pk=pk))
+        system = get_object_or_404(systems, pk=pk)
+
+        if stream == 'ndjson':
+            return StreamingHttpResponse(_stream_ndjson(system,
+                STREAM_CHUNK_SIZE), content_type='application/x-ndjson')
+        if stream == 'json':
+            return StreamingHttpResponse(_stream_json(system,
+                STREAM_CHUNK_SIZE), content_type='application/json')
+        if stream:
+            return HttpResponseBadRequest('stream must be ndjson or json.')
+
+        data = _system(system)
     else:
-        data = _systems(systems, include_transitions=False)
+        try:
+            data = _page(systems, request.GET)
+        except ValueError as e:
+            return HttpResponseBadRequest(unicode(e))
 
-    if request.is_ajax():
-        return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder),
-            mimetype='application/json')
-    return render(request, 'sts/systems.html')
+    return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder),
+        mimetype='application/json')
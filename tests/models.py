@@ -0,0 +1,9 @@
+from django.db import models
+from sts.models import STSModel
+
+
+class Door(STSModel):
+    name = models.CharField(max_length=20)
+
+    def __unicode__(self):
+        return self.name
@@ -2,6 +2,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'test.db',
+        # A file, unlike the default in-memory database, is shared by the
+        # threads of the concurrency tests
+        'TEST_NAME': 'test-sts.db',
+        'OPTIONS': {'timeout': 30},
     }
 }
 
@@ -13,3 +17,5 @@ INSTALLED_APPS = (
 )
 
 SECRET_KEY = 'abc123'
+
+ROOT_URLCONF = 'tests.urls'
@@ -1,9 +1,25 @@
+import json
 import time
-from django.test import TestCase
-from sts.models import STSError, System, State, Event
+import threading
+import weakref
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils.unittest import skipIf
+from django.test.utils import override_settings
+from sts import aio
+from sts.models import STSError, System, State, Event, Transition
+from .models import Door
 
 
-__all__ = ('StateTestCase', 'SystemTestCase')
+__all__ = ('StateTestCase', 'NameCacheTestCase', 'RollbackTestCase',
+    'UtilsTestCase', 'SystemTestCase', 'ConcurrencyTestCase', 'AsyncTestCase',
+    'ViewsTestCase')
+
+
+def shared_database():
+    "Returns False if the test database is not shared by threads."
+    return connection.vendor != 'sqlite' or connection.settings_dict\
+        .get('TEST_NAME') not in (None, '', ':memory:')
 
 
 class StateTestCase(TestCase):
@@ -19,9 +35,150 @@ class StateTestCase(TestCase):
         # Return an instance
         self.assertEqual(state, State.get(state))
 
+    def test_transition_state(self):
+        state = State.transition_state()
+        self.assertEqual(state.name, '(In Transition)')
+        self.assertEqual(State.TRANSITION, state)
+
+        system = System.objects.create()
+        trans = system.start_transition()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(State.transition_state('default'), state)
+            self.assertTrue(trans.in_transition())
+
+
+@override_settings(STS_NAME_CACHE_SIZE=2)
+class NameCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        State.cache.clear()
+
+    def tearDown(self):
+        State.cache.clear()
+
+    def test_get(self):
+        # Newly created rows are not cached
+        state = State.get('foo')
+        self.assertEqual(State.cache.stats()['size'], 0)
+
+        # Fetched, then cached
+        self.assertEqual(State.get('foo'), state)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(State.get('foo'), state)
+
+        self.assertEqual(State.cache.stats()['hits'], 1)
+
+    def test_eviction(self):
+        for name in ('a', 'b', 'c'):
+            State.objects.create(name=name)
+            State.get(name)
+
+        stats = State.cache.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['evictions'], 1)
+
+        # Least recently used is evicted
+        self.assertEqual(State.cache.get('a'), None)
+
+    def test_invalidation(self):
+        State.objects.create(name='foo')
+        state = State.get('foo')
+
+        state.name = 'bar'
+        state.save()
+        self.assertEqual(State.cache.get('foo'), None)
+
+        state.delete()
+        self.assertEqual(State.cache.get('bar'), None)
+
+
+class RollbackTestCase(TransactionTestCase):
+    "Rows read in a transaction which is rolled back must not be cached."
+    @override_settings(STS_NAME_CACHE_SIZE=2)
+    def test_name_cache(self):
+        State.cache.clear()
+
+        with transaction.commit_manually():
+            State.objects.create(name='foo')
+            State.get('foo')
+            transaction.rollback()
+
+        self.assertEqual(State.cache.stats()['size'], 0)
+        self.assertRaises(State.DoesNotExist, State.objects.get, name='foo')
+
+    def tearDown(self):
+        State._transition_states.clear()
+
+    def test_transition_state(self):
+        State.objects.filter(name='(In Transition)').delete()
+        State._transition_states.clear()
+
+        with transaction.commit_manually():
+            State.transition_state()
+            State.transition_state()
+            transaction.rollback()
+
+        system = System.objects.create()
+        system.start_transition()
+        self.assertTrue(State.objects.filter(pk=system.last_state_id).exists())
+
+        # Cached once read back after the commit
+        State.transition_state()
+        with self.assertNumQueries(0):
+            self.assertEqual(State.transition_state().pk, system.last_state_id)
+
+    @override_settings(STS_TRANSITION_GRAPHS={
+        'tests.door': {
+            None: {'Install': 'Closed'},
+            'Closed': {'Open': 'Opened'},
+        },
+    })
+    def test_graphs(self):
+        from sts import graphs
+
+        with transaction.commit_manually():
+            graphs.compile_graphs()
+            graphs.compile_graphs()
+            transaction.rollback()
+
+        self.assertFalse(graphs._graphs)
+
+        door = Door.objects.create(name='Graph')
+        door.transition('Closed', event='Install')
+        graphs.compile_graphs()
+
+        # The compiled graph and the snapshot answer without queries
+        with self.assertNumQueries(0):
+            self.assertEqual(door.allowed_events(), {'Open': 'Opened'})
+
+
+class UtilsTestCase(TestCase):
+    def test_format_duration(self):
+        from datetime import datetime, timedelta
+        from sts.utils import format_duration, get_natural_duration
+
+        start_time = datetime(2013, 5, 1)
+        durations = [0, 999, 1000, 1499, 1500, 59999, 60000, 61000, 3600000,
+            3660000, 7200000, 90000000, 700000000, 2600000000, 40000000000]
+
+        for duration in durations:
+            end_time = start_time + timedelta(milliseconds=duration)
+            for short in (False, True):
+                self.assertEqual(format_duration(duration, short),
+                    get_natural_duration(start_time, end_time, short))
+                self.assertEqual(get_natural_duration(start_time, end_time,
+                    short, fast=True), format_duration(duration, short))
+
+        self.assertEqual(format_duration(3660000), '1 hour, 1 minute')
+        self.assertEqual(format_duration(None), None)
+        self.assertEqual(format_duration(3660000, short=True), '1h, 1m')
+
 
 class SystemTestCase(TestCase):
     def setUp(self):
+        # Cached while the test transaction is still clean
+        State.transition_state()
         self.system = System()
         self.system.save()
 
@@ -61,6 +218,338 @@ class SystemTestCase(TestCase):
         self.assertEqual(State.objects.count(), 3)
         self.assertEqual(Event.objects.count(), 3)
 
+    def test_snapshot(self):
+        system = self.system
+
+        system.transition('Opened', event='Open', failed=True)
+        system.start_transition('Close')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(system.current_state(refresh=False),
+                State.TRANSITION)
+            self.assertTrue(system.in_transition(refresh=False))
+            self.assertFalse(system.failed_last_transition(refresh=False))
+
+        # A stale instance reads the current snapshot and saving it does
+        # not overwrite the snapshot
+        stale = System.objects.get(pk=system.pk)
+        system.end_transition('Closed')
+
+        self.assertFalse(stale.in_transition())
+        stale = System.objects.get(pk=system.pk)
+        system.transition('Opened')
+        stale.name = 'Renamed'
+        stale.save()
+
+        system = System.objects.get(pk=system.pk)
+        self.assertEqual(system.name, 'Renamed')
+        self.assertEqual(system.current_state().name, 'Opened')
+        self.assertEqual(len(system), 3)
+
+        # Reset and rebuild from the transitions
+        System.objects.filter(pk=system.pk).update(last_state=None,
+            last_failed=None, open_transition=None, transition_count=0)
+        System.objects.rebuild_snapshots(pks=[system.pk])
+
+        system = System.objects.select_related('last_state')\
+            .get(pk=system.pk)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(system.current_state(refresh=False).name,
+                'Opened')
+            self.assertFalse(system.in_transition(refresh=False))
+            self.assertFalse(system.failed_last_transition(refresh=False))
+            self.assertEqual(system.transition_count, 3)
+
+    def test_bulk(self):
+        systems = [System.objects.create(name='Bulk {0}'.format(i))
+            for i in range(3)]
+        systems[0].start_transition('Open')
+
+        results = System.objects.bulk_transition(systems, 'Closed',
+            event='Close', batch_size=2)
+
+        self.assertTrue(isinstance(results[0][1], STSError))
+        self.assertEqual([System.objects.get(pk=s.pk).current_state().name
+            for s in systems[1:]], ['Closed', 'Closed'])
+
+        results = System.objects.bulk_start_transition(systems, 'Open')
+        self.assertTrue(isinstance(results[0][1], STSError))
+
+        results = System.objects.bulk_end_transition(systems, 'Opened')
+        self.assertFalse([r for s, r in results if isinstance(r, STSError)])
+
+        for system in systems:
+            system = System.objects.get(pk=system.pk)
+            self.assertFalse(system.in_transition())
+            self.assertEqual(system.current_state().name, 'Opened')
+            self.assertEqual(system.transition_count, len(system.transitions.all()))
+
+        # Repeated systems are rejected rather than transitioned twice
+        system = systems[0]
+        results = System.objects.bulk_start_transition([system,
+            system.name], 'Open')
+        self.assertFalse(isinstance(results[0][1], STSError))
+        self.assertTrue(isinstance(results[1][1], STSError))
+
+        system.end_transition('Opened')
+        self.assertFalse(system.in_transition())
+
+    def test_buffer(self):
+        from sts.buffer import TransitionBuffer
+        from sts.contextmanagers import transition
+
+        buffer = TransitionBuffer(threaded=False, batch_size=2)
+        door = Door.objects.create(name='Buffered')
+
+        with self.assertNumQueries(0):
+            for i in range(3):
+                with transition(door, 'Closed', event='Close', buffer=buffer):
+                    pass
+            buffer.transition('Buffered', 'Opened')
+
+        self.assertEqual(buffer.stats()['queue_depth'], 4)
+        buffer.flush()
+
+        stats = buffer.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['written'], 4)
+        self.assertEqual(stats['flushes'], 2)
+
+        self.assertEqual(System.get(door).transition_count, 3)
+        self.assertEqual(System.get('Buffered').current_state().name, 'Opened')
+
+        # Buffers other than the default one are not kept alive
+        reference = weakref.ref(buffer)
+        del buffer
+        self.assertEqual(reference(), None)
+
+    def test_get_many(self):
+        from django.contrib.auth.models import User
+
+        users = [User.objects.create(username='user{0}'.format(i))
+            for i in range(3)]
+        system = System.get(users[0])
+
+        unsaved = System.get_many(users, create=False)
+        self.assertEqual(unsaved[0], system)
+        self.assertEqual([s.pk for s in unsaved[1:]], [None, None])
+
+        systems = System.get_many(users + ['Named', system])
+        self.assertEqual(systems[0], system)
+        self.assertEqual(systems[-1], system)
+        self.assertEqual(systems[-2].name, 'Named')
+        self.assertTrue(all(s.pk for s in systems))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(System.get_many(users), systems[:3])
+
+    def test_with_sts_state(self):
+        from sts.shortcuts import with_sts_state
+
+        doors = [Door.objects.create(name='Door {0}'.format(i))
+            for i in range(3)]
+        doors[0].system.transition('Opened', event='Open')
+        doors[1].system.start_transition('Close')
+
+        with self.assertNumQueries(3):
+            doors = with_sts_state(Door.objects.order_by('pk'))
+
+        with self.assertNumQueries(0):
+            self.assertEqual([door.current_state() and
+                door.current_state().name for door in doors],
+                ['Opened', State.TRANSITION.name, None])
+            self.assertEqual([door.in_transition() for door in doors],
+                [False, True, False])
+
+    def test_stats(self):
+        from datetime import timedelta
+        from django.utils import timezone
+
+        system = self.system
+        now = timezone.now().replace(minute=30)
+
+        for i, duration in enumerate([100, 200, 300, 400]):
+            start_time = now - timedelta(hours=i % 2)
+            system.transition('Done', event='Run', start_time=start_time,
+                end_time=start_time + timedelta(milliseconds=duration),
+                failed=duration == 400)
+
+        stats = Transition.objects.stats(system=system, state='Done')
+        self.assertEqual(stats['count'], 4)
+        self.assertEqual(stats['failures'], 1)
+        self.assertEqual(stats['failure_rate'], 0.25)
+        self.assertEqual((stats['min'], stats['avg'], stats['max']),
+            (100, 250, 400))
+        self.assertEqual(stats['percentiles'][50], 300)
+
+        buckets = Transition.objects.stats(event='Run', bucket='hour')
+        self.assertEqual([b['count'] for b in buckets], [2, 2])
+        self.assertEqual([b['failures'] for b in buckets], [1, 0])
+        self.assertEqual(buckets[1]['bucket'].hour, now.hour)
+
+        self.assertEqual(Transition.objects.stats(state='Other')['count'], 0)
+
+    @override_settings(STS_ROLLUPS=True)
+    def test_rollups(self):
+        from datetime import datetime, timedelta
+        from sts import rollups
+        from sts.models import Rollup
+
+        system = self.system
+        hour = datetime(2013, 5, 1, 10)
+
+        for i, duration in enumerate([100, 200, 300, 400]):
+            start_time = hour + timedelta(hours=i % 2, minutes=i)
+            system.transition('Done', event='Run', start_time=start_time,
+                end_time=start_time + timedelta(milliseconds=duration),
+                failed=duration == 400)
+
+        self.assertEqual(Rollup.objects.count(), 2)
+
+        stats = Transition.objects.stats(state='Done', use_rollups=True)
+        exact = Transition.objects.stats(state='Done')
+
+        for key in ('count', 'failures', 'min', 'avg', 'max'):
+            self.assertEqual(stats[key], exact[key])
+        self.assertTrue(stats['percentiles'][50] >= exact['percentiles'][50])
+
+        buckets = Transition.objects.stats(bucket='hour', since=hour,
+            use_rollups=True)
+        self.assertEqual([(b['bucket'], b['count']) for b in buckets],
+            [(hour, 2), (hour + timedelta(hours=1), 2)])
+
+        # Backfilling reproduces the incremental rollups
+        before = [r.get_summary() for r in Rollup.objects.all()]
+        Rollup.objects.all().delete()
+        self.assertEqual(rollups.backfill(), 4)
+        self.assertEqual([r.get_summary() for r in Rollup.objects.all()],
+            before)
+
+        self.assertEqual(rollups.compact(hour + timedelta(days=1)), 2)
+        self.assertEqual(Rollup.objects.get().bucket, 'day')
+        self.assertEqual(Transition.objects.stats(use_rollups=True)['count'],
+            4)
+
+        # Rollups are only read when asked for, they exclude open transitions
+        system.start_transition(start_time=hour)
+        self.assertEqual(Transition.objects.stats()['count'], 5)
+        self.assertEqual(Transition.objects.stats(use_rollups=True)['count'],
+            4)
+        system.end_transition('Done', end_time=hour)
+
+        # Windows splitting a daily rollup use the transitions
+        self.assertFalse(rollups.covers(since=hour))
+        self.assertRaises(ValueError, Transition.objects.stats, since=hour,
+            use_rollups=True)
+
+        # Rollups created concurrently are merged rather than failing
+        # the transition
+        Rollup.objects.all().delete()
+        system.transition('Done', start_time=hour, end_time=hour)
+        duplicate = Rollup.objects.get()
+        duplicate.pk = None
+        duplicate.save()
+
+        system.transition('Done', start_time=hour, end_time=hour)
+        self.assertEqual(Rollup.objects.get().get_summary()['count'], 3)
+
+    @override_settings(STS_RETENTION={'tests.missing': 30})
+    def test_archive_policy(self):
+        from django.core.management.base import CommandError
+        from sts.management.commands.sts_archive import Command
+
+        try:
+            Command().handle('/dev/null', format='ndjson', batch_size=1000,
+                verbosity=0)
+        except CommandError as e:
+            self.assertTrue('tests.missing' in unicode(e))
+        else:
+            self.fail('CommandError not raised')
+
+    def test_archive(self):
+        from datetime import timedelta
+        from StringIO import StringIO
+        from django.utils import timezone
+        from sts.archive import archive_transitions
+
+        old = timezone.now() - timedelta(days=60)
+        door = Door.objects.create(name='Old Door')
+
+        for system in (self.system, door.system):
+            for i in range(3):
+                system.transition('Count {0}'.format(i),
+                    start_time=old + timedelta(minutes=i))
+
+        out = StringIO()
+        count = archive_transitions(out, policy={'tests.door': 30},
+            batch_size=1)
+
+        # All but the latest transition of the door
+        self.assertEqual(count, 2)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+        system = System.objects.get(pk=door.system.pk)
+        self.assertEqual(system.transition_count, 1)
+        self.assertEqual(system.current_state().name, 'Count 2')
+        self.assertEqual(System.objects.get(pk=self.system.pk)
+            .transition_count, 3)
+
+        self.system.transition(u'D\xe9j\xe0 vu', message=u'\u2713',
+            start_time=old + timedelta(minutes=5))
+        self.system.transition('Count 3')
+
+        out = StringIO()
+        self.assertEqual(archive_transitions(out, format='csv',
+            policy={'default': 30}), 4)
+        self.assertEqual(len(out.getvalue().splitlines()), 4)
+        self.assertTrue(u'D\xe9j\xe0 vu'.encode('utf-8') in out.getvalue())
+
+    def test_verify_counts(self):
+        system = self.system
+        system.transition('Opened')
+        system.transition('Closed')
+
+        # Read from the system row
+        with self.assertNumQueries(1):
+            self.assertEqual(len(system), 2)
+
+        self.assertEqual(System.objects.verify_counts(), [])
+
+        System.objects.filter(pk=system.pk).update(transition_count=5)
+        self.assertEqual(System.objects.verify_counts(batch_size=1),
+            [(system.pk, 5, 2)])
+
+    def test_state_at(self):
+        from datetime import datetime, timedelta
+
+        t0 = datetime(2013, 5, 1, 10)
+        minute = timedelta(minutes=1)
+
+        system = self.system
+        other = System.objects.create(name='Other')
+
+        system.transition('Closed', start_time=t0, end_time=t0)
+        system.start_transition('Open', start_time=t0 + minute)
+        system.end_transition('Opened', end_time=t0 + 3 * minute)
+        other.transition('Closed', start_time=t0 + 2 * minute,
+            end_time=t0 + 2 * minute)
+
+        self.assertEqual(system.state_at(t0 - minute), None)
+        self.assertEqual(system.state_at(t0).name, 'Closed')
+        self.assertEqual(system.state_at(t0 + 2 * minute), State.TRANSITION)
+        self.assertEqual(system.state_at(t0 + 4 * minute).name, 'Opened')
+
+        def names(state, when):
+            return sorted(s.name or 'System' for s in
+                System.objects.in_state_at(state, when))
+
+        self.assertEqual(names('Closed', t0), ['System'])
+        self.assertEqual(names('Closed', t0 + 2 * minute), ['Other'])
+        self.assertEqual(names(State.TRANSITION, t0 + 2 * minute), ['System'])
+        self.assertEqual(names('Opened', t0 + 4 * minute), ['System'])
+        self.assertEqual(names('Missing', t0), [])
+
     def test_iteration(self):
         system = self.system
 
@@ -73,11 +562,22 @@ class SystemTestCase(TestCase):
             'Door Closed',
         ])
 
+        # Chunked and resumed
+        system.transition('Light Off', event='Switch Light')
+        self.assertEqual([str(t.state) for t in
+            system.iter_transitions(chunk_size=1, related=True)],
+            ['Shoe Buckled', 'Door Closed', 'Light Off'])
+
+        first = system[0]
+        self.assertEqual([str(t.state) for t in system.iter_transitions(
+            chunk_size=2, after=(first.start_time, first.pk))],
+            ['Door Closed', 'Light Off'])
+
     def test_getitem(self):
         system = self.system
 
-        self.assertEqual(system[:3], [])
-        self.assertEqual(system[2:3], [])
+        self.assertEqual(list(system[:3]), [])
+        self.assertEqual(list(system[2:3]), [])
         self.assertRaises(IndexError, system.__getitem__, 5)
         self.assertRaises(IndexError, system.__getitem__, slice(None, None, 2))
         self.assertRaises(ValueError, system.__getitem__, slice(None, None))
@@ -102,10 +602,24 @@ class SystemTestCase(TestCase):
 
         self.assertEqual(str(system[-1].state), 'Count 5')
 
+        self.assertEqual([str(t.state) for t in system[-4:-2]],
+            ['Count 2', 'Count 3'])
+
+        self.assertEqual([str(t.state) for t in system[1:-2]],
+            ['Count 2', 'Count 3'])
+
+        self.assertRaises(IndexError, system.__getitem__, -6)
+
+        # Slices are a single query and do not count the transitions
+        with self.assertNumQueries(1):
+            list(system[:-3])
+        with self.assertNumQueries(1):
+            list(system[-3:])
+
         # Bad slices..
-        self.assertEqual(system[-1:-3], [])
-        self.assertEqual(system[-1:2], [])
-        self.assertEqual(system[1:1], [])
+        self.assertEqual(list(system[-1:-3]), [])
+        self.assertEqual(list(system[-1:2]), [])
+        self.assertEqual(list(system[1:1]), [])
 
     def test_shortcuts(self):
         from django.contrib.auth.models import User
@@ -118,6 +632,142 @@ class SystemTestCase(TestCase):
         start_transition(user, 'Creating User')
         end_transition(user, 'User Created')
 
+    def test_signals(self):
+        from sts import signals
+        from sts.sinks import QueueSink
+
+        received = []
+
+        def receiver(signal, sender, system, transition, **kwargs):
+            received.append((signal, system, transition.state.name))
+
+        for signal in (signals.transition_started, signals.transition_ended,
+                signals.transition_failed):
+            signal.connect(receiver)
+
+        sink = QueueSink(threaded=False)
+        sink.connect()
+
+        try:
+            system = self.system
+            system.transition('Closed')
+            system.start_transition(event='Open')
+            self.assertRaises(STSError, system.transition, 'Closed')
+            system.end_transition('Opened', failed=True)
+            System.objects.bulk_transition(['Bulk 1', 'Bulk 2'], 'Closed')
+        finally:
+            for signal in (signals.transition_started,
+                    signals.transition_ended, signals.transition_failed):
+                signal.disconnect(receiver)
+            sink.close()
+
+        self.assertEqual(received[:4], [
+            (signals.transition_ended, system, 'Closed'),
+            (signals.transition_started, system, State.TRANSITION.name),
+            (signals.transition_ended, system, 'Opened'),
+            (signals.transition_failed, system, 'Opened'),
+        ])
+        self.assertEqual([(signal, s.name) for signal, s, state in
+            received[4:]], [
+                (signals.transition_ended, 'Bulk 1'),
+                (signals.transition_ended, 'Bulk 2'),
+            ])
+
+        # Interrupting a call does not leave the signals queued
+        @signals.sends_signals
+        def interrupted():
+            raise KeyboardInterrupt
+
+        self.assertRaises(KeyboardInterrupt, interrupted)
+        self.assertEqual(signals._local.pending, None)
+
+        records = sink.get(block=False)
+        self.assertEqual([record['signal'] for record in records],
+            ['ended', 'started', 'ended', 'failed', 'ended', 'ended'])
+        self.assertEqual(records[0]['system'], system.pk)
+        self.assertEqual(sink.stats()['written'], 6)
+
+    def test_model_proxies(self):
+        door = Door.objects.create(name='Front')
+
+        trans = door.transition('Closed', event='Close')
+        self.assertEqual(trans.state.name, 'Closed')
+
+        trans = door.start_transition(event='Open')
+        self.assertTrue(trans.in_transition())
+        self.assertTrue(door.in_transition())
+
+        trans = door.end_transition('Opened', failed=True)
+        self.assertEqual(trans.state.name, 'Opened')
+
+        # The snapshot kept on the instance answers without queries
+        with self.assertNumQueries(0):
+            self.assertEqual(door.current_state().name, 'Opened')
+            self.assertFalse(door.in_transition())
+            self.assertTrue(door.failed_last_transition())
+
+        # A fresh instance fetches the system and state once
+        door = Door.objects.get(pk=door.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(door.current_state().name, 'Opened')
+        with self.assertNumQueries(0):
+            door.current_state()
+            door.in_transition()
+            door.failed_last_transition()
+
+    @override_settings(STS_TRANSITION_GRAPHS={
+        'tests.door': {
+            None: {'Install': 'Closed'},
+            'Closed': {'Open': 'Opened'},
+            'Opened': {'Close': 'Closed'},
+        },
+    })
+    def test_transition_graph(self):
+        door = Door.objects.create(name='Graph')
+        self.assertEqual(door.allowed_events(), {'Install': 'Closed'})
+
+        self.assertRaises(STSError, door.transition, 'Opened', event='Open')
+        door.transition('Closed', event='Install')
+        self.assertEqual(door.allowed_events(), {'Open': 'Opened'})
+
+        self.assertRaises(STSError, door.transition, 'Closed', event='Close')
+        self.assertRaises(STSError, door.start_transition, event='Close')
+
+        door.start_transition(event='Open')
+        self.assertEqual(door.allowed_events(), {})
+        self.assertRaises(STSError, door.end_transition, 'Closed')
+        door.end_transition('Opened')
+        self.assertEqual(door.current_state().name, 'Opened')
+
+        # Failures can always be recorded
+        door.transition('Jammed', event='Kick', failed=True)
+        self.assertEqual(door.current_state().name, 'Jammed')
+
+        # The transition an open one was started from is not archived
+        from datetime import timedelta
+        from StringIO import StringIO
+        from django.utils import timezone
+        from sts.archive import archive_transitions
+
+        old = timezone.now() - timedelta(days=60)
+        door = Door.objects.create(name='Archived')
+        for i, (state, event) in enumerate([('Closed', 'Install'),
+                ('Opened', 'Open'), ('Closed', 'Close')]):
+            door.transition(state, event=event,
+                start_time=old + timedelta(minutes=i))
+        door.start_transition(event='Open',
+            start_time=old + timedelta(minutes=3))
+
+        self.assertEqual(archive_transitions(StringIO(),
+            policy={'tests.door': 30}), 2)
+        door.end_transition('Opened')
+        self.assertEqual(door.current_state().name, 'Opened')
+
+        # Systems without a graph accept any transition
+        system = System.get('Unconstrained')
+        self.assertEqual(system.allowed_events(), None)
+        system.transition('Anything', event='Whatever')
+
     def test_context_manager(self):
         from sts.contextmanagers import transition
 
@@ -141,3 +791,272 @@ class SystemTestCase(TestCase):
             pass
 
         self.assertEqual(system.current_state().name, 'Annoyed')
+
+    def test_deferred_context_manager(self):
+        from sts.contextmanagers import transition
+
+        system = System.objects.create(name='Sleeper')
+
+        with transition(system, 'Awake', event='Nap', deferred=True) as trans:
+            # Nothing is written until the block exits
+            self.assertEqual(Transition.objects.filter(system=system).count(), 0)
+            time.sleep(1)
+            trans.message = 'That was a short nap!'
+
+        system = System.objects.get(pk=system.pk)
+        self.assertEqual(system.current_state().name, 'Awake')
+        self.assertEqual(len(system), 1)
+
+        trans = system[0]
+        self.assertEqual(trans.event.name, 'Nap')
+        self.assertEqual(trans.message, 'That was a short nap!')
+        self.assertTrue(1000 < trans.duration < 2000)
+
+        @transition('Sleeper', 'Awake', deferred=True, fail_state='Annoyed')
+        def nap(fail=False):
+            if fail:
+                raise Exception
+            return 'Zzz'
+
+        self.assertEqual(nap(), 'Zzz')
+        self.assertRaises(Exception, nap, fail=True)
+
+        system = System.objects.get(pk=system.pk)
+        self.assertEqual(len(system), 3)
+        self.assertEqual(system.current_state().name, 'Annoyed')
+        self.assertTrue(system.failed_last_transition())
+
+        # A failed write does not mask the exception raised in the block
+        system.start_transition()
+
+        def wake(error=None):
+            with transition(system, 'Awake', deferred=True):
+                if error:
+                    raise error
+
+        self.assertRaises(STSError, wake)
+        self.assertRaises(ValueError, wake, ValueError)
+        self.assertEqual(len(system), 4)
+
+
+@skipIf(not shared_database(), 'Requires a database shared by threads.')
+class ConcurrencyTestCase(TransactionTestCase):
+    def run_threads(self, func, count=10):
+        results = []
+        errors = []
+        barrier = threading.Event()
+
+        def target():
+            barrier.wait()
+            try:
+                func()
+                results.append(True)
+            except STSError:
+                results.append(False)
+            except Exception as e:
+                # Anything else, e.g. a deadlock, fails the test
+                errors.append(e)
+            finally:
+                connections['default'].close()
+
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        barrier.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        return results
+
+    def test_start_transition(self):
+        system = System.objects.create(name='Contended')
+
+        for i in range(5):
+            results = self.run_threads(lambda:
+                System.objects.get(pk=system.pk).start_transition('Open'))
+
+            self.assertEqual(results.count(True), 1)
+            self.assertEqual(system.transitions
+                .filter(state=State.TRANSITION).count(), 1)
+
+            results = self.run_threads(lambda:
+                System.objects.get(pk=system.pk).end_transition('Opened'))
+
+            self.assertEqual(results.count(True), 1)
+            self.assertFalse(system.transitions
+                .filter(state=State.TRANSITION).exists())
+
+        system = System.objects.get(pk=system.pk)
+        self.assertEqual(system.transition_count, 5)
+        self.assertFalse(system.in_transition())
+
+
+@skipIf(not shared_database(), 'Requires a database shared by threads.')
+@skipIf(aio.asyncio is None, 'Requires asyncio.')
+class AsyncTestCase(TransactionTestCase):
+    def setUp(self):
+        self.loop = aio.asyncio.new_event_loop()
+        aio.asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        aio.shutdown()
+        self.loop.close()
+
+    def test_transition(self):
+        run = self.loop.run_until_complete
+
+        systems = [System.objects.create(name='System {0}'.format(i))
+            for i in range(20)]
+
+        run(aio.asyncio.gather(*[system.atransition('Done', event='Work')
+            for system in systems]))
+
+        for system in systems:
+            self.assertEqual(system.current_state().name, 'Done')
+        self.assertEqual(Transition.objects.filter(state__name='Done')
+            .count(), 20)
+
+        self.assertEqual(run(State.aget('Done')).name, 'Done')
+        self.assertEqual(run(Event.aget('Work')).name, 'Work')
+        self.assertEqual(run(System.aget('System 0')), systems[0])
+
+    @override_settings(STS_ASYNC_WORKERS=1)
+    def test_connections(self):
+        run = self.loop.run_until_complete
+
+        def connect():
+            connection.cursor()
+            return connection.connection, connection.is_dirty()
+
+        def fail():
+            connection.cursor()
+            raise ValueError
+
+        # Kept open between calls, without a transaction left open
+        first, dirty = run(aio.run(connect))
+        self.assertFalse(dirty)
+        self.assertTrue(run(aio.run(connect))[0] is first)
+
+        # Closed when a call raises
+        self.assertRaises(ValueError, run, aio.run(fail))
+        self.assertTrue(run(aio.run(lambda: connection.connection)) is None)
+
+    def test_context_manager(self):
+        from sts.contextmanagers import transition
+
+        run = self.loop.run_until_complete
+        system = System.objects.create(name='Sleeper')
+
+        manager = transition(system, 'Awake', event='Nap')
+        run(manager.__aenter__())
+        self.assertTrue(System.objects.get(pk=system.pk).in_transition())
+        run(manager.__aexit__(None, None, None))
+
+        system = System.objects.get(pk=system.pk)
+        self.assertEqual(system.current_state().name, 'Awake')
+
+        manager = transition(system, 'Awake', event='Nap', deferred=True)
+        run(manager.__aenter__())
+        self.assertEqual(len(System.objects.get(pk=system.pk)), 1)
+        run(manager.__aexit__(Exception, Exception(), None))
+
+        system = System.objects.get(pk=system.pk)
+        self.assertEqual(len(system), 2)
+        self.assertEqual(system.current_state().name, 'Fail')
+
+
+class ViewsTestCase(TestCase):
+    def create(self, count):
+        for i in range(count):
+            door = Door.objects.create(name='Door')
+            door.system.transition('Opened', event='Open')
+        System.objects.create(name='Empty')
+
+    def test_systems_queries(self):
+        from sts.views import _systems
+
+        self.create(1)
+        with self.assertNumQueries(2):
+            _systems(System.objects.filter(transition_count__gt=0)
+                .select_related('content_type'), include_transitions=False)
+
+        self.create(5)
+        with self.assertNumQueries(2):
+            data = _systems(System.objects.filter(transition_count__gt=0)
+                .select_related('content_type'), include_transitions=False)
+
+        self.assertEqual(len(data), 6)
+        self.assertEqual(data[0]['name'], 'Door')
+
+    def test_orphans(self):
+        self.create(2)
+        Door.objects.all()[0].delete()
+
+        response = self.client.get('/sts/', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(len(json.loads(response.content)['results']), 1)
+
+    def test_pagination(self):
+        self.create(5)
+        system = Door.objects.all()[0].system
+        system.start_transition('Close')
+
+        seen = []
+        cursor = ''
+
+        while cursor is not None:
+            response = self.client.get('/sts/', {'limit': 2, 'cursor': cursor},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            data = json.loads(response.content)
+            self.assertTrue(len(data['results']) <= 2)
+            seen.extend(system['id'] for system in data['results'])
+            cursor = data['next']
+
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+        # Transitions move the system to the front
+        self.assertEqual(seen[0], system.pk)
+
+        response = self.client.get('/sts/', {'state': 'Opened'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(len(json.loads(response.content)['results']), 4)
+
+        response = self.client.get('/sts/', {'content_type': 'tests.door',
+            'failed': 'false'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(len(json.loads(response.content)['results']), 5)
+
+        response = self.client.get('/sts/', {'cursor': 'bogus'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream(self):
+        system = System.objects.create(name='Streamed')
+        for i in range(3):
+            system.transition('Count {0}'.format(i), event='Incr')
+
+        url = '/sts/{0}/'.format(system.pk)
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        expected = json.loads(response.content)
+
+        response = self.client.get(url, {'stream': 'json'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        content = ''.join(response)
+        self.assertEqual(json.loads(content), expected)
+
+        response = self.client.get(url, {'stream': 'ndjson'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        lines = ''.join(response).splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+            expected['transitions'])
+
+        # Streams do not require an AJAX request
+        response = self.client.get(url, {'stream': 'ndjson'})
+        self.assertEqual(''.join(response).splitlines(), lines)
+
+        response = self.client.get(url, HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(''.join(response).splitlines(), lines)
+
+        response = self.client.get(url, {'stream': 'xml'})
+        self.assertEqual(response.status_code, 400)
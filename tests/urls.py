@@ -0,0 +1,6 @@
+from django.conf.urls import url, patterns, include
+
+
+urlpatterns = patterns('',
+    url(r'^sts/', include('sts.urls')),
+)